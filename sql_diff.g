@@ -1233,8 +1233,14 @@ class Schema:
 						yield (None, "delete from "+bq(t)+" where "+sk, skl)
 
 
-	def update(self, db1,db2, days=None, force=False,force_equal=False, tables=()):
-		"""Generate data update statements if both sources are databases"""
+	def update(self, db1,db2, days=None, force=False,force_equal=False, tables=(), batch=500, checksum=0):
+		"""\
+			Generate data update statements if both sources are databases.
+			Differing rows are fetched `batch` keys at a time.
+			With `checksum`, key ranges are compared by row count and
+			checksum first and split until they have at most `checksum`
+			rows; only ranges that differ are compared row by row.
+			"""
 
 
 		odb=Db(db1)
@@ -1368,6 +1374,41 @@ class Schema:
 			assert len(fl) == flen+len(fk)
 			return fl
 
+		class Rows(dict):
+			"""Rows by key. `extra`: rows whose key wasn't asked for"""
+			extra = 0
+
+		def load_many(table,db,f,fk,kl):
+			"""\
+				Fetch the rows for a list of keys with one query.
+				Keys which contain NULL are skipped; see load().
+				"""
+			res = Rows()
+			kl = [ k for k in kl if None not in k ]
+			if not kl: return res
+			vals={}
+			cond=[]
+			for i,k in enumerate(kl):
+				vs=[]
+				for j,v in enumerate(k):
+					n = "k%d_%d" % (i,j)
+					vals[n] = v
+					vs.append("${%s}" % (n,))
+				cond.append(vs[0] if len(f) == 1 else "("+",".join(vs)+")")
+			col = ",".join(map(bq,f))
+			if len(f) > 1: col = "("+col+")"
+			want = set( tuple(k) for k in kl )
+
+			for r in db.DoSelect("select "+",".join(map(bq,f))+","+",".join([ bq(x.name) for x in fk ])+" from "+table.name+" where "+col+" in ("+",".join(cond)+")", _store=1,_empty=1, **vals):
+				k = tuple(r[:len(f)])
+				if k in want:
+					res[k] = list(r)
+				else:
+					# the database's idea of equality differs from ours,
+					# e.g. case-insensitive collation
+					res.extra += 1
+			return res
+
 		ov=[]
 		def out(db,tx,**txf):
 			if verbose>3:
@@ -1432,13 +1473,119 @@ class Schema:
 			else:
 				ts_field_pos = None
 
+			def compare(row_diff,xa,xb):
+				"""Emit the statements which turn row xb into row xa"""
+				if xa and xb: # both tables have data
+					if ts_field:
+						try:
+							idc= (xa[ts_field_pos] > xb[ts_field_pos])
+						except TypeError:
+							idc= (xb[ts_field_pos] is None and xa[ts_field_pos] is not None)
+					else:
+						idc=0
+					if row_diff or idc or not iseq(xa,xb):
+						if force or idc:
+							wk,wkl = key(ts_field,ts_field_pos,xa,xb,fieldpos,keys)
+							pn,pnl = print_update(posval2dict(fieldpos,xa,xb))
+							if pn:
+								pnl.update(wkl)
+								if keys:
+									yield out(ndb,"update %s set %s \n\t where %s" % (bq(table.name),pn,wk), _empty=1, **pnl)
+								else:
+									yield out(ndb,"update %s set %s" % (bq(table.name),pn),**pnl)
+				elif row_diff < 0: # alt => einfügen
+					if xa:
+						pn,pnl = print_insert(posval2dict(fieldpos,xa))
+						if pn: yield out(ndb, "replace into %s %s" % (bq(table.name),pn),**pnl)
+				elif xb: # neu => raus
+					wk,wkl = key(ts_field,ts_field_pos,xb,None,fieldpos,keys)
+					pn,pnl = print_update(posval2dict(fieldpos,xb))
+					pnl.update(wkl)
+					if keys:
+						yield out(ndb, "delete from %s where %s" % (bq(table.name),wk),**pnl)
+					else:
+						yield out(ndb, "delete from %s" % (bq(table.name),),**pnl)
+				else: # kein 'xb' : ???
+					print >>sys.stderr, "XB leer",ts_field,ts_field_pos,fieldpos,keys
+
+			def flush(pending):
+				"""Fetch a batch of rows from both sides, then compare them"""
+				ra = load_many(table,odb,keys,fld,[ p[1] for p in pending ])
+				rb = load_many(table,ndb,keys,fld,[ p[2] for p in pending ])
+				for row_diff,dfa,dfb in pending:
+					xa = ra.get(tuple(dfa))
+					if xa is None and (ra.extra or None in dfa):
+						xa = load(dfa, "src",table,odb,keys,fld)
+					xb = rb.get(tuple(dfb))
+					if xb is None and (rb.extra or None in dfb):
+						xb = load(dfb, "dst",table,ndb,keys,fld)
+					for res in compare(row_diff,xa,xb):
+						yield res
+
+			def key_range(lo,hi):
+				"""WHERE clause for the keys in (lo,hi]. None is unbounded."""
+				col = ",".join(map(bq,keys))
+				if len(keys) > 1: col = "("+col+")"
+				cond=[]
+				vals={}
+				for op,lim,n in ((">",lo,"lo"),("<=",hi,"hi")):
+					if lim is None: continue
+					vs=[]
+					for j,v in enumerate(lim):
+						vals["%s_%d" % (n,j)] = v
+						vs.append("${%s_%d}" % (n,j))
+					cond.append(col+" "+op+" "+(vs[0] if len(keys) == 1 else "("+",".join(vs)+")"))
+				if days and ts_field is not None:
+					cond.append(ts_field+days)
+				if not cond: return "",vals
+				return " where "+" and ".join(cond), vals
+
+			cols = map(bq,keys)+[ bq(f.name) for f in fld ]
+			crc = "crc32(concat_ws('#',"+",".join(cols)+",concat("+",".join([ "isnull("+c+")" for c in cols ])+")))"
+
+			def differ(lo,hi):
+				"""\
+					Yield the key ranges within (lo,hi] whose checksums differ,
+					splitting them until they have at most `checksum` rows.
+					"""
+				tt,vals = key_range(lo,hi)
+				ca = odbq.DoFn("select count(*),bit_xor("+crc+") from "+table.name+tt, **vals)
+				cb = ndbq.DoFn("select count(*),bit_xor("+crc+") from "+table.name+tt, **vals)
+				if tuple(ca) == tuple(cb): return
+				n = max(ca[0],cb[0])
+				if n <= checksum:
+					yield lo,hi
+					return
+				try:
+					mid = (odbq if ca[0] >= cb[0] else ndbq).DoFn("select "+",".join(map(bq,keys))+" from "+table.name+tt+" order by "+",".join(map(bq,keys))+" limit 1 offset %d" % (n//2-1,), **vals)
+				except NoData:
+					yield lo,hi
+					return
+				mid = tuple(mid)
+				for r in differ(lo,mid): yield r
+				for r in differ(mid,hi): yield r
+
+			def scan(db,ranges):
+				for lo,hi in ranges:
+					tt,vals = key_range(lo,hi)
+					for r in db.DoSelect("select "+ts_sel+" "+",".join(map(bq,keys))+" from "+table.name+tt+" order by "+",".join(map(bq,keys)), _store=0,_empty=1, **vals):
+						yield r
+
+			pending = []
 			trace(0,table.name,keys)
 			if keys:
-				tt = ""
-				if days and ts_field is not None:
-					tt = " where "+ts_field+days
-				ost = odbq.DoSelect("select "+ts_sel+" "+",".join(map(bq,keys))+" from "+table.name+" "+tt+" order by "+",".join(map(bq,keys)), _store=0,_empty=1)
-				nst = ndbq.DoSelect("select "+ts_sel+" "+",".join(map(bq,keys))+" from "+table.name+" "+tt+" order by "+",".join(map(bq,keys)), _store=0,_empty=1)
+				ranges = [(None,None)]
+				if checksum and not [ k for k in keys if table.col[k].nullable or old_table.col[k].nullable ]:
+					# compare checksums first; only scan the ranges which differ
+					ranges = []
+					for lo,hi in differ(None,None):
+						if ranges and ranges[-1][1] == lo:
+							ranges[-1] = (ranges[-1][0],hi)
+						else:
+							ranges.append((lo,hi))
+					trace(0,table.name,len(ranges),"ranges differ")
+				ost = scan(odbq,ranges)
+				nst = scan(ndbq,ranges)
 			else:
 				ost = odbq.DoSelect("select "+ts_sel+"1 from "+table.name, _store=0,_empty=1)
 				nst = ndbq.DoSelect("select "+ts_sel+"2 from "+table.name, _store=0,_empty=1)
@@ -1473,41 +1620,17 @@ class Schema:
 					else: dfa=dxa
 					if row_diff<0: dfb=dxa
 					else: dfb=dxb
-					xa = load(dfa, "src",table,odb,keys,fld)
-					xb = load(dfb, "dst",table,ndb,keys,fld)
-
-					if xa and xb: # both tables have data
-						if ts_field:
-							try:
-								idc= (xa[ts_field_pos] > xb[ts_field_pos])
-							except TypeError:
-								idc= (xb[ts_field_pos] is None and xa[ts_field_pos] is not None)
-						else:
-							idc=0
-						if row_diff or idc or not iseq(xa,xb):
-							if force or idc:
-								wk,wkl = key(ts_field,ts_field_pos,xa,xb,fieldpos,keys)
-								pn,pnl = print_update(posval2dict(fieldpos,xa,xb))
-								if pn:
-									pnl.update(wkl)
-									if keys:
-										yield out(ndb,"update %s set %s \n\t where %s" % (bq(table.name),pn,wk), _empty=1, **pnl)
-									else:
-										yield out(ndb,"update %s set %s" % (bq(table.name),pn),**pnl)
-					elif row_diff < 0: # alt => einfügen
-						if xa:
-							pn,pnl = print_insert(posval2dict(fieldpos,xa))
-							if pn: yield out(ndb, "replace into %s %s" % (bq(table.name),pn),**pnl)
-					elif xb: # neu => raus
-						wk,wkl = key(ts_field,ts_field_pos,xb,None,fieldpos,keys)
-						pn,pnl = print_update(posval2dict(fieldpos,xb))
-						pnl.update(wkl)
-						if keys:
-							yield out(ndb, "delete from %s where %s" % (bq(table.name),wk),**pnl)
-						else:
-							yield out(ndb, "delete from %s" % (bq(table.name),),**pnl)
-					else: # kein 'xb' : ???
-						print >>sys.stderr, "XB leer",ts_field,ts_field_pos,fieldpos,keys
+					if keys and fld and batch > 1:
+						pending.append((row_diff,dfa,dfb))
+						if len(pending) >= batch:
+							for res in flush(pending):
+								yield res
+							pending = []
+					else:
+						xa = load(dfa, "src",table,odb,keys,fld)
+						xb = load(dfb, "dst",table,ndb,keys,fld)
+						for res in compare(row_diff,xa,xb):
+							yield res
 				if keys:
 					if row_diff <= 0: index_a = next_row("src",table,ost)
 					if row_diff >= 0: index_b = next_row("dst",table,nst)
@@ -1520,6 +1643,9 @@ class Schema:
 						try: st.next()
 						except StopIteration: pass
 						else: raise RuntimeError("TooManydata")
+			if pending:
+				for res in flush(pending):
+					yield res
 
 		def _trans():
 			#if opts.execute or opts.execstr:
@@ -1586,6 +1712,10 @@ def main():
 						help="ignore equal timestamps", default=False)
 	parser.add_option("-t","--days", action="store", dest="days", type="int",
 						help="only consider the last N days", default=0)
+	parser.add_option("-b","--batch", action="store", dest="batch", type="int",
+						help="fetch differing rows N at a time", default=500)
+	parser.add_option("-C","--checksum", action="store", dest="checksum", type="int",
+						help="compare key range checksums down to N rows first (MySQL)", default=0)
 	parser.add_option("-p","--preload", action="store_true", dest="preload",
 						help="pre-load data descriptions", default=False)
 	parser.add_option("-n","--skip-change", action="store", dest="skip_flags",
@@ -1746,7 +1876,7 @@ def main():
 
 		if not opts.db1file and not opts.db2file:
 			# read from database
-			updo = db1.update(opts.db1,opts.db2, days=opts.days, force=opts.force,force_equal=opts.force_equal, tables=args)
+			updo = db1.update(opts.db1,opts.db2, days=opts.days, force=opts.force,force_equal=opts.force_equal, tables=args, batch=opts.batch, checksum=opts.checksum)
 		else:
 			# analyze actual table dumps
 			if not opts.db1file: db1.read_data(tables=args)
@@ -32,11 +32,33 @@ This module provides a thread-safe way to access any Python SQL database with
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from time import time,sleep
+try:
+	from time import perf_counter
+except ImportError: # Python 2
+	from time import time as perf_counter
+try:
+	_text = unicode
+	_strings = basestring
+except NameError: # Python 3
+	_text = _strings = str
 import sys
 import os
 import re
+import io
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import math
+import random
+from array import array
 from sys import exc_info
-from threading import local
+from threading import local,Lock,Event
+from collections import OrderedDict,namedtuple,deque
+from itertools import islice,repeat,count
+from copy import deepcopy
+from decimal import Decimal
+from uuid import UUID
+import datetime
 
 class CommitThread(Exception):
 	u"""\
@@ -53,7 +75,7 @@ class FakeLocal(object):
 		"""
 	pass
 
-__all__ = ["Db","NoData","ManyData"]
+__all__ = ["Db","NoData","ManyData","PoolTimeout","Row","Retry","AttemptTimeout","StmtStats","SlowLog","ResultCache"]
 
 def fixup_error(cmd):
 	"""Append the full command to the error message"""
@@ -64,33 +86,316 @@ def fixup_error(cmd):
 
 class _NOTGIVEN: pass
 
+def _chunks(it, n):
+	"""Split an iterable into lists of at most n items"""
+	it = iter(it)
+	while True:
+		res = list(islice(it,n))
+		if not res:
+			return
+		yield res
+
+def _fetch_batches(curs, batch, probe=None):
+	"""Iterate over a result, fetching `batch` rows at a time"""
+	if hasattr(curs,'fetchmany'):
+		while True:
+			if probe is not None:
+				probe.start()
+			rows = curs.fetchmany(batch)
+			if probe is not None:
+				probe.fetched(rows)
+			if not rows:
+				return
+			yield rows
+	elif curs.rows: # ultramysql: the result is a list
+		if probe is not None:
+			probe.fetched(curs.rows)
+		yield curs.rows
+
+def _fetch_rows(curs, batch, probe=None):
+	"""Iterate over a result's rows, fetching `batch` rows at a time"""
+	for rows in _fetch_batches(curs, batch, probe):
+		for row in rows:
+			yield row
+
+try:
+	array('q')
+	_int_code = 'q'
+except ValueError: # Python 2
+	_int_code = 'l'
+
+def _typecode(vals):
+	"""The array typecode which can hold these values, or None"""
+	tc = _int_code
+	for v in vals:
+		t = type(v)
+		if t is float:
+			tc = 'd'
+		elif t is not int:
+			return None
+	return tc
+
+class _Columns(object):
+	"""\
+		Collect batches of rows into one array per column.
+
+		Columns which only contain integers (or integers and floats) are
+		stored as array.array('q') (or 'd'), everything else in lists.
+		"""
+	def __init__(self, names):
+		self.names = names
+		self.cols = [None]*len(names)
+		self.n = 0
+
+	def add(self, rows):
+		self.n += len(rows)
+		for i,vals in enumerate(zip(*rows)):
+			self.cols[i] = self._extend(self.cols[i], vals)
+
+	@staticmethod
+	def _extend(col, vals):
+		if isinstance(col,list):
+			col.extend(vals)
+			return col
+		tc = _typecode(vals)
+		if tc is not None:
+			try:
+				new = array(tc,vals)
+			except OverflowError:
+				pass
+			else:
+				if col is None:
+					return new
+				if col.typecode == tc:
+					col.extend(new)
+				elif tc == _int_code: # ints into a float column
+					col.extend(vals)
+				else:
+					col = array('d',col)
+					col.extend(new)
+				return col
+		col = list(col) if col is not None else []
+		col.extend(vals)
+		return col
+
+	def result(self, use_numpy=True):
+		numpy = None
+		if use_numpy:
+			try:
+				import numpy
+			except ImportError:
+				pass
+		res = {}
+		for name,col in zip(self.names,self.cols):
+			if col is None:
+				col = []
+			if numpy is not None:
+				if isinstance(col,array):
+					col = numpy.frombuffer(col, dtype=numpy.float64 if col.typecode == 'd' else numpy.int64)
+				else:
+					col = numpy.array(col, dtype=object)
+			res[name] = col
+		return res
+
+## COPY text format, as used by PostgreSQL's COPY and MySQL's LOAD DATA:
+## tab-separated, \N is NULL, backslash escapes
+
+_copy_esc = {ord("\\"):"\\\\", ord("\t"):"\\t", ord("\n"):"\\n", ord("\r"):"\\r"}
+
+def _copy_line(row):
+	"""Encode one row as a line of COPY text"""
+	res = []
+	for v in row:
+		if v is None:
+			res.append("\\N")
+			continue
+		if isinstance(v,bool):
+			v = int(v)
+		elif isinstance(v,bytes):
+			v = v.decode("utf-8")
+		res.append(_text(v).translate(_copy_esc))
+	return "\t".join(res)+"\n"
+
+class _CopyReader(object):
+	"""\
+		A read-only file which encodes rows to COPY text on demand,
+		so that a generator can be bulk-loaded in constant memory.
+		"""
+	def __init__(self, rows):
+		self.rows = iter(rows)
+		self.buf = b""
+		self.count = 0
+
+	def read(self, size=-1):
+		buf = [self.buf]
+		n = len(self.buf)
+		while size < 0 or n < size:
+			try:
+				row = next(self.rows)
+			except StopIteration:
+				break
+			line = _copy_line(row).encode("utf-8")
+			buf.append(line)
+			n += len(line)
+			self.count += 1
+		data = b"".join(buf)
+		if size < 0:
+			self.buf = b""
+		else:
+			self.buf = data[size:]
+			data = data[:size]
+		return data
+
+def _mysql_session(isolation):
+	res = ["SET autocommit=0, wait_timeout=7200"] # 2h
+	if isolation:
+		res.append("SET SESSION TRANSACTION ISOLATION LEVEL "+isolation)
+	return res
+
+# dbtype => session statements which the server rejected
+_session_unsupported = {}
+
+_explainable_re = re.compile(r"\s*(select|insert|update|delete|replace|with)\b", re.I)
+
 class db_data(object):
 	sequential = False
 	_store = 1 # safe default
 	_cursor = True
+	isolation = None
+	# a failed statement aborts the transaction, so guard EXPLAIN with a savepoint
+	explain_savepoint = False
+
+	# Replication lag in seconds: a query, and the column holding it
+	lag_sql = None
+	lag_column = "lag"
+
+	# Can DoMany rewrite single-row INSERTs to multi-row VALUES lists?
+	# If so, limit each statement's size (estimated) and parameter count.
+	multi_values = False
+	values_bytes = None
+	values_params = None
+
 	def __init__(self, **kwargs):
-		"""standard keywords: host,port,database,username,password"""
-		for f in "host port database username password".split():
+		"""\
+			standard keywords: host,port,database,username,password
+			multi-row inserts: values_bytes,values_params
+			"""
+		for f in "host port database username password values_bytes values_params".split():
 			v = kwargs.pop(f,_NOTGIVEN)
 			if v is _NOTGIVEN:
 				continue
-			if f == "port":
+			if f in ("port","values_bytes","values_params"):
 				v=int(v)
 			setattr(self,f,v)
 		kwargs.setdefault("charset","utf8")
 		self.kwargs = kwargs
 
+	def session_sql(self):
+		"""\
+			SQL statements which set up a new connection (no autocommit,
+			long wait timeout, `isolation` level). Settings which the driver
+			accepts as connect options are passed by `conn` instead.
+			"""
+		return ()
+
+	def explain_sql(self, sql):
+		"""The statement which shows the plan of `sql`, or None"""
+		if _explainable_re.match(sql) is None:
+			return None
+		return "EXPLAIN "+sql
+
+	def ping(self, conn):
+		"""Check that an idle connection is alive; raise an exception if not"""
+		if self._cursor:
+			curs = conn.cursor()
+			curs.execute("SELECT 1")
+			curs.fetchall()
+		else:
+			conn.query("SELECT 1")
+
+	def cursor(self, conn, store, batch, cargs=()):
+		"""\
+			Return a cursor for a SELECT. If `store` is false, the result
+			should be streamed from the server instead of being buffered by
+			the client; `batch` is the number of rows fetched at once.
+			"""
+		return conn.cursor(*cargs)
+
+	# Bulk transfer. These return None if the back-end has no fast path.
+	def copy_in(self, conn, table, columns, rows):
+		"""Load a sequence of rows into a table; return the row count"""
+		return None
+
+	def copy_out(self, conn, cmd, file):
+		"""Write a query's result to a file, in COPY text format"""
+		return None
+
+	def values_batches(self, row_sql, args):
+		"""\
+			Split a list of per-row arguments into batches which
+			fit this back-end's multi-row VALUES limits.
+			"""
+		batch = []
+		nbytes = nparams = 0
+		for a in args:
+			size = len(row_sql)+1
+			for v in a:
+				size += len(v)+2 if isinstance(v,(str,bytes)) else 8
+			if batch and ((self.values_bytes and nbytes+size > self.values_bytes) or
+					(self.values_params and nparams+len(a) > self.values_params)):
+				yield batch
+				batch = []
+				nbytes = nparams = 0
+			batch.append(a)
+			nbytes += size
+			nparams += len(a)
+		if batch:
+			yield batch
+
 class _db_mysql(db_data):
 	_store = 1
 	host="localhost"
 	port=3306
+	multi_values = True
+	values_bytes = 1<<20 # well below max_allowed_packet
+	lag_sql = "SHOW SLAVE STATUS"
+	lag_column = "Seconds_Behind_Master"
 	def __init__(self, **kwargs):
 		self.DB = __import__("MySQLdb")
 		self.DB.cursors = __import__("MySQLdb.cursors").cursors
 		super(_db_mysql,self).__init__(**kwargs)
 
 	def conn(self):
-		return self.DB.connect(db=self.database, host=self.host, user=self.username, passwd=self.password, port=self.port, **self.kwargs)
+		# MySQLdb sends the init command as part of connecting, and it
+		# allows multiple statements
+		kw = dict(self.kwargs)
+		init = _mysql_session(self.isolation)
+		if kw.get("init_command"):
+			init.insert(0,kw["init_command"])
+		kw["init_command"] = ";".join(init)
+		kw.setdefault("autocommit",False)
+		return self.DB.connect(db=self.database, host=self.host, user=self.username, passwd=self.password, port=self.port, **kw)
+
+	def ping(self, conn):
+		conn.ping()
+
+	def cursor(self, conn, store, batch, cargs=()):
+		if store:
+			return conn.cursor(*cargs)
+		return conn.cursor(self.DB.cursors.SSCursor)
+
+	def copy_in(self, conn, table, columns, rows):
+		# The client must be allowed to send files.
+		if not self.kwargs.get("local_infile",False):
+			return None
+		from tempfile import NamedTemporaryFile
+		with NamedTemporaryFile(suffix=".txt") as f:
+			for row in rows:
+				f.write(_copy_line(row).encode("utf-8"))
+			f.flush()
+			curs = conn.cursor()
+			curs.execute("LOAD DATA LOCAL INFILE %s INTO TABLE "+table+" CHARACTER SET utf8mb4 ("+",".join(columns)+")", (f.name,))
+			return curs.rowcount
 
 class _db_ultramysql(db_data):
 	_store = 1
@@ -107,6 +412,9 @@ class _db_ultramysql(db_data):
 		c.connect(self.host, self.port, self.username, self.password, self.database, False, "utf8")
 		return c
 
+	def session_sql(self):
+		return _mysql_session(self.isolation)
+
 class _db_odbc(db_data):
 	def __init__(self, **kwargs):
 		self.DB = __import__("mx.ODBC.iODBC")
@@ -117,25 +425,100 @@ class _db_odbc(db_data):
 			self.host = self.host+":"+str(self.port)
 			self.port=None
 
-		return self.DB.connect(database=self.database, host=self.host, user=self.username, password=self.password)
+		c = self.DB.connect(database=self.database, host=self.host, user=self.username, password=self.password)
+		try:
+			c.setconnectoption(self.DB.SQL.AUTOCOMMIT, self.DB.SQL.AUTOCOMMIT_OFF)
+		except AttributeError:
+			pass
+		return c
+
+class _NamedCursor(object):
+	"""\
+		A psycopg2 server-side cursor. Its description is only known after
+		the first fetch, so execute() fetches the first batch right away.
+		"""
+	def __init__(self, curs, batch):
+		self.curs = curs
+		self.batch = batch
+		self.rows = None
+
+	def execute(self, *a):
+		self.curs.execute(*a)
+		self.rows = self.curs.fetchmany(self.batch)
+
+	def fetchmany(self, n):
+		if self.rows is not None:
+			rows,self.rows = self.rows,None
+			return rows
+		return self.curs.fetchmany(n)
+
+	def __getattr__(self, k):
+		return getattr(self.curs, k)
 
 class _db_postgres(db_data):
+	_cursor_seq = count(1)
+	explain_savepoint = True
+	# a standby which has replayed everything it received isn't lagging,
+	# no matter how old the last transaction is
+	lag_sql = """SELECT CASE WHEN NOT pg_is_in_recovery()
+		OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+		ELSE EXTRACT(EPOCH FROM clock_timestamp()-pg_last_xact_replay_timestamp())
+		END AS lag"""
+
 	def __init__(self, **kwargs):
 		self.DB = __import__("psycopg2")
 		super(_db_postgres,self).__init__(**kwargs)
 
 	def conn(self):
-		return self.DB.connect(database=self.database,host=self.host, user=self.username, password=self.password, port=self.port)
+		# psycopg2 doesn't autocommit; the isolation level is a server option
+		kw = {}
+		if self.isolation:
+			kw["options"] = "-c default_transaction_isolation="+self.isolation.replace(" ","\\ ")
+		return self.DB.connect(database=self.database,host=self.host, user=self.username, password=self.password, port=self.port, **kw)
+
+	def cursor(self, conn, store, batch, cargs=()):
+		if store:
+			return conn.cursor(*cargs)
+		# named cursors are server-side
+		curs = conn.cursor("sqlmix_%d" % next(self._cursor_seq))
+		curs.itersize = batch
+		return _NamedCursor(curs, batch)
+
+	def copy_in(self, conn, table, columns, rows):
+		f = _CopyReader(rows)
+		curs = conn.cursor()
+		curs.copy_expert("COPY "+table+" ("+",".join(columns)+") FROM STDIN", f)
+		return f.count
+
+	def copy_out(self, conn, cmd, file):
+		curs = conn.cursor()
+		cmd = curs.mogrify(*cmd)
+		if isinstance(cmd,bytes):
+			cmd = cmd.decode("utf-8")
+		curs.copy_expert("COPY ("+cmd+") TO STDOUT", file)
+		return curs.rowcount
 
 class _db_sqlite(db_data):
+	# sqlite3 cursors step through the result on demand,
+	# so the default cursor already streams
 	sequential = True
+	multi_values = True
 	def __init__(self, **kwargs):
 		self.DB = __import__("sqlite3.dbapi2")
 		if hasattr(self.DB,"dbapi2"): self.DB=self.DB.dbapi2
+		# SQLITE_MAX_VARIABLE_NUMBER
+		self.values_params = 32766 if self.DB.sqlite_version_info >= (3,32,0) else 999
 		super(_db_sqlite,self).__init__(**kwargs)
 
+	def explain_sql(self, sql):
+		if _explainable_re.match(sql) is None:
+			return None
+		return "EXPLAIN QUERY PLAN "+sql
+
 	def conn(self):
-		return self.DB.connect(self.database)
+		# Db makes sure that a connection is only used by one thread at a
+		# time, but pooled connections move between threads
+		return self.DB.connect(self.database, check_same_thread=False)
 
 _databases = {
 	    "mysql": _db_mysql,
@@ -166,6 +549,11 @@ def _do_numeric(name, arg, params):
 def _done_numeric(cmd,args):
 	return (cmd,args)
 
+## dollar: '$n' (PostgreSQL's own placeholders)
+def _do_dollar(name, arg, params):
+	arg.append(params[name])
+	return "$" + str(len(arg))
+
 ## named: ':name'
 
 def _init_named():
@@ -199,6 +587,7 @@ def _done_pyformat(cmd,args):
 _parsers = {
 		"qmark"   : (_init_qmark,_do_qmark,_done_qmark),
 		"numeric" : (_init_numeric,_do_numeric,_done_numeric),
+		"dollar"  : (_init_qmark,_do_dollar,_done_qmark),
 		"named"   : (_init_named,_do_named,_done_named),
 		"format"  : (_init_format,_do_format,_done_format),
 		"pyformat": (_init_pyformat,_do_pyformat,_done_pyformat),
@@ -211,27 +600,1252 @@ class NoData(Exception):
 	pass
 class ManyData(Exception):
 	pass
+class PoolTimeout(Exception):
+	pass
+class AttemptTimeout(Exception):
+	"""A job took longer than its retry policy's per-attempt timeout"""
+	pass
 #class NoDatabase(Exception):
 #	pass
 
+# MySQL error numbers
+_mysql_errors = {
+	1205: "lock_timeout",
+	1213: "deadlock",
+	2006: "conn_lost", # server has gone away
+	2013: "conn_lost", # lost connection during query
+	2055: "conn_lost",
+}
+# SQLSTATE codes; class 08 is "connection exception"
+_sqlstates = {
+	"40P01": "deadlock",
+	"40001": "serialization",
+	"55P03": "lock_timeout",
+}
+_lost_msgs = ("server closed the connection","connection already closed",
+	"terminating connection","connection is closed","connection was closed")
+
+try:
+	ConnectionError
+except NameError: # Python 2
+	from socket import error as ConnectionError
+
+# modules whose exceptions carry a MySQL error number as args[0]
+_mysql_modules = ("MySQLdb","_mysql_exceptions","pymysql","trio_mysql")
+
+def _is_mysql_error(exc):
+	for c in type(exc).__mro__:
+		if c.__module__.split(".")[0] in _mysql_modules:
+			return True
+	return False
+
+def error_kind(exc):
+	"""\
+		Classify a driver error as "deadlock", "lock_timeout",
+		"serialization", "conn_lost" or "timeout" (AttemptTimeout).
+		Returns None for anything else.
+		"""
+	if isinstance(exc,AttemptTimeout):
+		return "timeout"
+	state = getattr(exc,"pgcode",None) or getattr(exc,"sqlstate",None)
+	if state:
+		if state.startswith("08"):
+			return "conn_lost"
+		return _sqlstates.get(state)
+	args = getattr(exc,"args",())
+	if args and type(args[0]) is int and _is_mysql_error(exc):
+		return _mysql_errors.get(args[0])
+	if isinstance(exc,ConnectionError):
+		return "conn_lost"
+	msg = str(exc).lower()
+	if type(exc).__name__ == "OperationalError" and "is locked" in msg:
+		return "lock_timeout" # sqlite: busy timeout expired
+	for m in _lost_msgs:
+		if m in msg:
+			return "conn_lost"
+	return None
+
+class _Attempt(object):
+	"""One try of a Retry loop. Use it like `with db:`."""
+	delay = None
+	used = False
+
+	def __init__(self, policy, db, n):
+		self.policy = policy
+		self.db = db
+		self.n = n
+
+	def __enter__(self):
+		self.used = True
+		return self.db
+
+	def _rollback(self):
+		try:
+			self.db.rollback()
+		except Exception:
+			pass # the connection has been dropped
+
+	def __exit__(self, a,b,c):
+		if b is None or isinstance(b,CommitThread):
+			try:
+				self.db.commit()
+			except Exception as e:
+				self._rollback()
+				self.delay = self.policy.check(e, self.n)
+				if self.delay is None:
+					raise
+				return b is None
+			self.policy.check(None, self.n)
+			return False
+		self._rollback()
+		if isinstance(b,Exception):
+			self.delay = self.policy.check(b, self.n)
+		return self.delay is not None
+
+class Retry(object):
+	"""\
+		Retry policy for transactions which fail because of a deadlock,
+		a lock wait timeout, a serialization failure or a lost connection.
+
+		attempts: total number of tries.
+		base, cap: the delay before retry n is random between 0 and
+		min(cap, base*2**n) seconds.
+		timeout: per-attempt time limit. Only the async and Twisted
+		front-ends enforce this; a blocking driver call can't be interrupted.
+		kinds: the error classes (see `error_kind`) to retry.
+
+		Usage:
+		>>> policy = Retry(attempts=5)
+		>>> for attempt in policy.attempts(db):
+		>>>     with attempt:
+		>>>         db.Do("...")
+
+		Alternately, pass the policy as `retry` to db(job, retry), or to
+		the async or Twisted pool's __call__. Policies may be shared;
+		`stats()` returns their counters.
+		"""
+	kinds = frozenset(("deadlock","lock_timeout","serialization","conn_lost","timeout"))
+
+	def __init__(self, attempts=5, base=0.02, cap=2.0, timeout=None, kinds=None):
+		self.max_attempts = int(attempts)
+		self.base = float(base)
+		self.cap = float(cap)
+		self.timeout = float(timeout) if timeout is not None else None
+		if kinds is not None:
+			self.kinds = frozenset(kinds)
+		self._lock = Lock()
+		self.calls = 0
+		self.errors = 0
+		self.giveups = 0
+		self.retries = {}
+		self.slept = 0.0
+
+	@classmethod
+	def get(cls, retry):
+		"""Turn a `retry` argument (a number of retries, or a policy) into a policy"""
+		if isinstance(retry,Retry):
+			return retry
+		return cls(attempts=1+int(retry or 0))
+
+	def classify(self, exc):
+		kind = error_kind(exc)
+		return kind if kind in self.kinds else None
+
+	def check(self, exc, n):
+		"""\
+			Attempt `n` (counting from zero) succeeded (exc is None) or
+			failed. Returns the delay before the next attempt, or None
+			if there should be none.
+			"""
+		with self._lock:
+			if exc is None:
+				self.calls += 1
+				return None
+			kind = self.classify(exc)
+			if kind is None:
+				self.calls += 1
+				self.errors += 1
+				return None
+			if n+1 >= self.max_attempts:
+				self.calls += 1
+				self.giveups += 1
+				return None
+			self.retries[kind] = self.retries.get(kind,0)+1
+			delay = random.uniform(0, min(self.cap, self.base*(2**n)))
+			self.slept += delay
+			return delay
+
+	def attempts(self, db):
+		"""Yield context managers for each try of a transaction on `db`"""
+		n = 0
+		while True:
+			a = _Attempt(self, db, n)
+			yield a
+			if not a.used:
+				raise RuntimeError("Use each attempt with a 'with' statement")
+			if a.delay is None:
+				return
+			sleep(a.delay)
+			n += 1
+
+	def stats(self):
+		"""\
+			Counters: calls (finished jobs), errors (not retryable),
+			giveups (out of attempts), retries (by kind), slept (seconds).
+			"""
+		with self._lock:
+			return dict(calls=self.calls, errors=self.errors, giveups=self.giveups,
+				retries=dict(self.retries), slept=self.slept)
+
+class StmtEvent(namedtuple("StmtEvent","kind sql dbtype prep execute fetch rows bytes error")):
+	"""\
+		One statement, as reported to Db(instrument=...).
+
+		sql is the prepared template (parameters are not included). prep,
+		execute and fetch are seconds. rows counts fetched or affected rows,
+		bytes estimates the size of fetched data (numbers count as 8).
+		error is the exception's class name, or None.
+		"""
+	__slots__ = ()
+
+def _row_bytes(rows):
+	n = 0
+	for row in rows:
+		for v in row:
+			n += len(v) if isinstance(v,(str,bytes,bytearray)) else 8
+	return n
+
+class _Probe(object):
+	"""Time the phases of one statement"""
+	__slots__ = ("emit","kind","dbtype","sql","t","prep","execute","fetch","rows","bytes","error",
+		"src","cmd","slow_log","explain","slow")
+
+	def __init__(self, emit, kind, dbtype, slow_log=None, explain=None):
+		self.emit = emit
+		self.kind = kind
+		self.dbtype = dbtype
+		self.slow_log = slow_log
+		self.explain = explain
+		self.slow = None
+		self.sql = self.src = self.cmd = None
+		self.prep = self.execute = self.fetch = 0.0
+		self.rows = self.bytes = 0
+		self.error = None
+		self.t = perf_counter()
+
+	def start(self):
+		self.t = perf_counter()
+
+	def _lap(self):
+		t = perf_counter()
+		d,self.t = t-self.t,t
+		return d
+
+	def prepped(self, cmd, src=None):
+		self.prep += self._lap()
+		self.cmd = cmd
+		self.src = src
+		self.sql = cmd[0] if isinstance(cmd,tuple) else cmd
+
+	def executed(self):
+		self.execute += self._lap()
+
+	def fetched(self, rows):
+		self.fetch += self._lap()
+		if rows:
+			self.rows += len(rows)
+			self.bytes += _row_bytes(rows)
+
+	def done(self, error=None, rows=None):
+		"""Report the statement. Call this exactly once."""
+		if rows is not None:
+			self.rows = rows
+		if error is not None:
+			self.error = type(error).__name__
+		evt = StmtEvent(self.kind, self.sql, self.dbtype, self.prep,
+			self.execute, self.fetch, self.rows, self.bytes, self.error)
+		if self.emit is not None:
+			self.emit(evt)
+		sl = self.slow_log
+		if sl is None or evt.prep+evt.execute+evt.fetch < sl.threshold:
+			return
+		if sl.explain and evt.error is None and isinstance(self.cmd,tuple):
+			if self.explain is None:
+				self.slow = evt # the async caller runs EXPLAIN
+				return
+			sl.write(self, evt, self.explain(self.cmd))
+		else:
+			sl.write(self, evt)
+
+_hist_step = math.log(1.1)
+
+class _Hist(object):
+	"""Latency histogram with 10% wide buckets, starting at 1µs"""
+	__slots__ = ("count","errors","rows","bytes","total","max","buckets")
+
+	def __init__(self):
+		self.count = self.errors = self.rows = self.bytes = 0
+		self.total = self.max = 0.0
+		self.buckets = {}
+
+	def add(self, t, evt):
+		self.count += 1
+		if evt.error is not None:
+			self.errors += 1
+		self.rows += evt.rows
+		self.bytes += evt.bytes
+		self.total += t
+		if t > self.max:
+			self.max = t
+		b = int(math.log(t*1e6)/_hist_step) if t > 1e-6 else 0
+		self.buckets[b] = self.buckets.get(b,0)+1
+
+	def percentile(self, q):
+		"""Upper bound of the bucket holding the q-th quantile"""
+		n = q*self.count
+		k = 0
+		for b in sorted(self.buckets):
+			k += self.buckets[b]
+			if k >= n:
+				return min(1e-6*math.exp((b+1)*_hist_step), self.max)
+		return self.max
+
+class StmtStats(object):
+	"""\
+		In-process statement statistics: per-template counts, errors,
+		rows, bytes and latency percentiles.
+
+		>>>	db = Db(..., instrument=True) # or instrument=StmtStats()
+		>>>	…
+		>>>	print(db.instrument.dump())
+
+		At most `max_templates` statements are tracked separately; the
+		rest are counted as "(other)".
+		"""
+	def __init__(self, max_templates=1000):
+		self.max_templates = max_templates
+		self._lock = Lock()
+		self.stmts = {}
+
+	def __call__(self, evt):
+		t = evt.prep+evt.execute+evt.fetch
+		with self._lock:
+			h = self.stmts.get(evt.sql)
+			if h is None:
+				key = evt.sql if len(self.stmts) < self.max_templates else "(other)"
+				h = self.stmts.get(key)
+				if h is None:
+					h = self.stmts[key] = _Hist()
+			h.add(t, evt)
+
+	def report(self):
+		"""One dict per template, slowest total time first"""
+		with self._lock:
+			res = [dict(sql=sql, count=h.count, errors=h.errors, rows=h.rows,
+					bytes=h.bytes, total=h.total, max=h.max, p50=h.percentile(0.5),
+					p95=h.percentile(0.95), p99=h.percentile(0.99))
+				for sql,h in self.stmts.items()]
+		res.sort(key=lambda x: x["total"], reverse=True)
+		return res
+
+	def dump(self, fp=None):
+		"""Write the report to a file as JSON, or return it as a string"""
+		if fp is None:
+			return json.dumps(self.report(), indent=1)
+		json.dump(self.report(), fp, indent=1)
+
+	def reset(self):
+		with self._lock:
+			self.stmts = {}
+
+_slow_loggers = {}
+_slow_lock = Lock()
+
+def _slow_logger(path):
+	if path is None:
+		return logging.getLogger("sqlmix.slow")
+	path = os.path.abspath(os.path.expanduser(path))
+	with _slow_lock:
+		log = _slow_loggers.get(path)
+		if log is None:
+			log = logging.Logger("sqlmix.slow")
+			h = RotatingFileHandler(path, maxBytes=SlowLog.max_bytes, backupCount=SlowLog.backups)
+			h.setFormatter(logging.Formatter("%(message)s"))
+			log.addHandler(h)
+			_slow_loggers[path] = log
+	return log
+
+class SlowLog(object):
+	"""\
+		Record statements which take at least `threshold` seconds as JSON
+		lines: to a rotating file, or to the "sqlmix.slow" logger if there
+		is no path. With `explain`, the statement's plan is fetched on the
+		same connection and included.
+
+		Entries hold the statement, the names of its parameters (not their
+		values), and the timings of StmtEvent in milliseconds.
+		"""
+	max_bytes = 10<<20
+	backups = 5
+
+	def __init__(self, threshold, path=None, explain=False):
+		self.threshold = threshold
+		self.explain = explain
+		self.log = _slow_logger(path)
+
+	def write(self, probe, evt, plan=None):
+		names = []
+		if probe.src:
+			for n in _param_re.findall(probe.src):
+				if n not in names:
+					names.append(n)
+		e = dict(time=time(), kind=evt.kind, dbtype=evt.dbtype, sql=evt.sql,
+			params=names, ms=round((evt.prep+evt.execute+evt.fetch)*1000,3),
+			prep_ms=round(evt.prep*1000,3), execute_ms=round(evt.execute*1000,3),
+			fetch_ms=round(evt.fetch*1000,3), rows=evt.rows, bytes=evt.bytes,
+			error=evt.error)
+		if plan is not None:
+			e["plan"] = plan
+		self.log.warning(json.dumps(e, default=str))
+
+_param_re = re.compile(r"\$\{([a-zA-Z][a-zA-Z_0-9]*)\}")
+
+_values_re = re.compile(r"^(\s*insert\b.*\bvalues\s*)(\(.*\))\s*;?\s*$", re.I|re.S)
+
+def _single_group(s):
+	"""Check that this string is exactly one parenthesized group"""
+	depth = 0
+	quote = None
+	for i,c in enumerate(s):
+		if quote:
+			if c == quote:
+				quote = None
+		elif c in "'\"":
+			quote = c
+		elif c == "(":
+			depth += 1
+		elif c == ")":
+			depth -= 1
+			if depth == 0:
+				return i == len(s)-1
+	return False
+
+class _ParamNames(object):
+	"""\
+		Stand-in for the keyword arguments while compiling a template:
+		every parameter's value is its own name.
+		"""
+	def __getitem__(self, name):
+		return name
+_param_names = _ParamNames()
+
+class PrepTemplate(object):
+	"""\
+		A statement whose ${name} placeholders have been rewritten
+		for a specific parameter style.
+
+		`sql` is the driver-specific statement text, `names` the parameter
+		names in the order the driver wants them. `keys` lists each
+		parameter once, in order of first appearance; positional rows
+		are mapped onto it.
+		"""
+	__slots__ = ("sql","names","keys","mapping","_done")
+
+	def __init__(self, sql, names, mapping, done):
+		self.sql = sql
+		self.names = names
+		self.keys = list(OrderedDict.fromkeys(names))
+		self.mapping = mapping
+		self._done = done
+
+	def __call__(self, params):
+		"""Gather the arguments; return a (sql,args) tuple for `execute`"""
+		if self.mapping:
+			args = dict((n,params[n]) for n in self.names)
+		else:
+			args = [params[n] for n in self.names]
+		return self._done(self.sql,args)
+
+	def rows(self, rows, params=None):
+		"""\
+			Yield the driver arguments for a sequence of rows.
+			Rows are dicts or sequences (see `keys`); `params` supplies
+			values common to all of them.
+			"""
+		keys = self.keys
+		for row in rows:
+			if not isinstance(row,dict):
+				if len(row) != len(keys):
+					raise ValueError("Row length mismatch",keys,row)
+				row = dict(zip(keys,row))
+			if params:
+				p = params.copy()
+				p.update(row)
+				row = p
+			yield self(row)[1]
+
+class PrepCache(object):
+	"""\
+		A bounded LRU cache of compiled statement templates,
+		keyed on (statement text, paramstyle).
+
+		Set `maxsize` to zero to disable caching.
+		`hits` and `misses` count lookups.
+		"""
+	def __init__(self, maxsize=1000):
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self._data = OrderedDict()
+		self._lock = Lock()
+
+	def __len__(self):
+		return len(self._data)
+
+	def get(self, key):
+		with self._lock:
+			try:
+				res = self._data.pop(key)
+			except KeyError:
+				self.misses += 1
+				return None
+			self._data[key] = res # most recently used; no move_to_end on Python 2
+			self.hits += 1
+			return res
+
+	def put(self, key, tmpl):
+		if self.maxsize <= 0:
+			return
+		with self._lock:
+			self._data[key] = tmpl
+			while len(self._data) > self.maxsize:
+				self._data.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+			self.hits = 0
+			self.misses = 0
+
+	def stats(self):
+		return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses)
+
+prep_cache = PrepCache()
+
+## result rows
+
+class Row(object):
+	"""\
+		A compact result row which allows access by index and by name:
+		>>>	r = db.DoFn("select id,name from sometable where id=${id}", id=1, _row=True)
+		>>>	assert r[0] == r.id == r["id"]
+
+		All rows of a query share one column index and tuple of names;
+		each row only holds a tuple of its values. A repeated column name
+		is renamed to "_<position>", as namedtuple(rename=True) does.
+		"""
+	__slots__ = ("_index","_names","_values")
+
+	def __init__(self, index, values, names=None):
+		if names is None:
+			names = tuple(sorted(index, key=index.get))
+		self._index = index
+		self._names = names
+		self._values = values
+
+	def __getitem__(self, k):
+		if isinstance(k,_strings):
+			return self._values[self._index[k]]
+		return self._values[k]
+
+	def __getattr__(self, k):
+		# copy and pickle look up special names on an empty instance
+		if k.startswith("__") or k in Row.__slots__:
+			raise AttributeError(k)
+		try:
+			return self._values[self._index[k]]
+		except KeyError:
+			raise AttributeError(k)
+
+	def __reduce__(self):
+		return (Row, (self._index,self._values,self._names))
+
+	def __len__(self):
+		return len(self._values)
+
+	def __iter__(self):
+		return iter(self._values)
+
+	def __eq__(self, other):
+		if isinstance(other,Row):
+			other = other._values
+		return self._values == other
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return hash(self._values)
+
+	def keys(self):
+		return list(self._names)
+
+	def get(self, k, default=None):
+		try:
+			return self._values[self._index[k]]
+		except KeyError:
+			return default
+
+	def _asdict(self):
+		return OrderedDict(zip(self._names,self._values))
+
+	def __repr__(self):
+		return "Row(%s)" % (", ".join("%s=%r" % kv for kv in zip(self._names,self._values)),)
+
+class _SlotsRecord(object):
+	"""Base class for generated __slots__ row classes"""
+	__slots__ = ()
+	_fields = ()
+	_setters = ()
+
+	def __init__(self, vals):
+		for s,v in zip(self._setters,vals):
+			s(self,v)
+
+	def __iter__(self):
+		for f in self._fields:
+			yield getattr(self,f)
+
+	def __len__(self):
+		return len(self._fields)
+
+	def _asdict(self):
+		return dict((f,getattr(self,f)) for f in self._fields)
+
+	def __repr__(self):
+		return "%s(%s)" % (self.__class__.__name__, ", ".join("%s=%r" % (f,getattr(self,f)) for f in self._fields))
+
+def _slots_class(names):
+	fields = namedtuple("Row", names, rename=True)._fields
+	cls = type("Row", (_SlotsRecord,), dict(__slots__=fields, _fields=fields))
+	cls._setters = tuple(getattr(cls,f).__set__ for f in fields)
+	return cls
+
+def _make_factory(names, kind):
+	if kind == "row":
+		seen = set()
+		rnames = []
+		for i,n in enumerate(names):
+			if n in seen:
+				n = "_%d" % (i,)
+			seen.add(n)
+			rnames.append(n)
+		rnames = tuple(rnames)
+		index = dict((n,i) for i,n in enumerate(rnames))
+		return lambda val: Row(index, val if type(val) is tuple else tuple(val), rnames)
+	elif kind is True:
+		return lambda val: dict(zip(names,val))
+	elif kind == "namedtuple":
+		return namedtuple("Row", names, rename=True)._make
+	elif kind == "slots":
+		return _slots_class(names)
+	elif isinstance(kind,type):
+		return lambda val: kind(zip(names,val))
+	raise ValueError("Unknown row type",kind)
+
+_factories = PrepCache(maxsize=200)
+
+def row_factory(names, kind):
+	"""\
+		Return a procedure which builds a result row from a tuple of values.
+
+		`names` are the column names. `kind` is "row" for a Row, True
+		for a dict, a type (which gets the (name,value) pairs),
+		"namedtuple", or "slots" for a generated class with __slots__.
+
+		Factories are cached per (kind, column names).
+		"""
+	names = tuple(names)
+	key = (kind,names)
+	res = _factories.get(key)
+	if res is None:
+		res = _make_factory(names, kind)
+		_factories.put(key,res)
+	return res
+
+def _row_factory(curs, kv):
+	"""The row factory requested by _row/_dict/_record, or None"""
+	kind = "row" if kv.get("_row",None) else kv.get("_dict",None) or kv.get("_record",None)
+	if not kind:
+		return None
+	return row_factory((x[0] for x in curs.description), kind)
+
+## result cache
+
+_table_re = re.compile(r"\b(?:from|join|into|update|table|truncate)\s+(.*?)(?=\b(?:where|group|order|limit|having|join|inner|left|right|cross|full|natural|straight_join|on|using|union|set|values|select|returning|for|window|offset|default|partition)\b|[();]|$)", re.I|re.S)
+
+_tables_cache = PrepCache(maxsize=200)
+
+def _tables(sql):
+	"""\
+		The (lower-case, unqualified) names of the tables a statement
+		refers to. This is a heuristic; an empty result means "unknown".
+		"""
+	res = _tables_cache.get(sql)
+	if res is None:
+		res = set()
+		for m in _table_re.finditer(sql):
+			for part in m.group(1).split(","):
+				words = part.split()
+				if words and words[0].lower() == "table":
+					words = words[1:]
+				if words:
+					name = words[0].split(".")[-1].strip('`"[]').lower()
+					if name:
+						res.add(name)
+		res = frozenset(res)
+		_tables_cache.put(sql,res)
+	return res
+
+# values which a caller can't modify, so cache hits may share them
+_immutable = (type(None), bool, int, float, complex, _text, str, bytes, Decimal, UUID,
+	datetime.date, datetime.time, datetime.timedelta)
+try:
+	_immutable += (long,)
+except NameError: # Python 3
+	pass
+
+class _CachedResult(object):
+	__slots__ = ("description","rows","tables","expires","size","mutable")
+
+	def __init__(self, description, rows, tables, expires):
+		self.description = description
+		self.rows = rows
+		self.tables = tables
+		self.expires = expires
+		self.size = _row_bytes(rows) + 64*(len(rows)+1)
+		# e.g. JSON or array columns: every caller gets its own copy
+		self.mutable = any(type(v) not in _immutable for r in rows for v in r)
+
+	def row(self, r):
+		return deepcopy(r) if self.mutable else r
+
+class ResultCache(object):
+	"""\
+		Results of DoFn and DoSelect calls with `_cache=ttl`, keyed on the
+		prepared statement and its arguments.
+
+		Entries expire after `ttl` seconds. The least recently used ones
+		are evicted when there are more than `maxsize` of them or they
+		hold more than `max_bytes` (estimated). Writes with Do, DoMany and
+		CopyIn drop the entries which read from the tables they touch when
+		their transaction commits; a write whose tables can't be determined
+		clears the cache.
+
+		Rows are stored as tuples; dicts, records and Row objects are
+		built for each caller. Results with mutable values (e.g. JSON or
+		array columns) are deep-copied on every hit, so callers can't
+		modify the cached data.
+		"""
+	def __init__(self, maxsize=1000, max_bytes=16<<20):
+		self.maxsize = maxsize
+		self.max_bytes = max_bytes
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self._data = OrderedDict()
+		self._by_table = {} # table name => keys
+		self._gen = {} # table name => number of invalidations
+		self._gen_all = 0
+		self._lock = Lock()
+
+	def lookup(self, cmd):
+		"""\
+			Return (key,entry). The entry is None on a miss; the key is
+			None if the statement's arguments can't be hashed.
+			"""
+		args = cmd[1] if len(cmd) > 1 else ()
+		if isinstance(args,dict):
+			args = tuple(sorted(args.items()))
+		key = (cmd[0], tuple(args))
+		try:
+			hash(key)
+		except TypeError:
+			return None,None
+		with self._lock:
+			e = self._data.get(key)
+			if e is not None and e.expires <= time():
+				self._remove(key)
+				e = None
+			if e is None:
+				self.misses += 1
+			else:
+				self._data[key] = self._data.pop(key) # most recently used
+				self.hits += 1
+			return key,e
+
+	def generation(self, tables):
+		"""Note the state of these tables before reading them"""
+		with self._lock:
+			return (self._gen_all,) + tuple(self._gen.get(t,0) for t in sorted(tables))
+
+	def store(self, key, tables, gen, description, rows, ttl):
+		"""\
+			Add a result, unless one of its tables has been written to
+			since `generation` returned `gen`. Returns the new entry.
+			"""
+		description = tuple(tuple(d) for d in description)
+		rows = tuple(tuple(r) for r in rows)
+		e = _CachedResult(description, rows, tables, time()+ttl)
+		if key is None:
+			return e
+		with self._lock:
+			if gen != (self._gen_all,) + tuple(self._gen.get(t,0) for t in sorted(tables)):
+				return e
+			if key in self._data:
+				self._remove(key)
+			self._data[key] = e
+			self.bytes += e.size
+			for t in tables:
+				self._by_table.setdefault(t,set()).add(key)
+			while self._data and (len(self._data) > self.maxsize or self.bytes > self.max_bytes):
+				self._remove(next(iter(self._data)))
+		return e
+
+	def _remove(self, key):
+		e = self._data.pop(key)
+		self.bytes -= e.size
+		for t in e.tables:
+			keys = self._by_table.get(t)
+			if keys is not None:
+				keys.discard(key)
+				if not keys:
+					del self._by_table[t]
+
+	def invalidate(self, tables):
+		"""Drop the entries which read these tables; all of them if there are none"""
+		with self._lock:
+			if not tables:
+				self._gen_all += 1
+				self._data.clear()
+				self._by_table.clear()
+				self.bytes = 0
+				return
+			for t in tables:
+				self._gen[t] = self._gen.get(t,0)+1
+				for key in list(self._by_table.get(t,())):
+					self._remove(key)
+
+	def clear(self):
+		self.invalidate(())
+
+	def stats(self):
+		return dict(size=len(self._data), maxsize=self.maxsize, bytes=self.bytes,
+			max_bytes=self.max_bytes, hits=self.hits, misses=self.misses)
+
+_uncached_args = ("_cache","_dict","_record","_row","_head","_callback")
+
+def _fill_args(kv):
+	"""Keywords for the DoSelect which fills a cache entry"""
+	kv = dict((k,v) for k,v in kv.items() if k not in _uncached_args)
+	kv["_head"] = 2
+	kv["_empty"] = True
+	return kv
+
+def _cached_one(e, cmd, kv):
+	"""DoFn's result, from a cache entry"""
+	if not e.rows:
+		raise NoData(cmd)
+	if len(e.rows) > 1:
+		raise ManyData(cmd)
+	make_row = _row_factory(e, kv)
+	r = e.row(e.rows[0])
+	return make_row(r) if make_row is not None else r
+
+def _cached_rows(e, cmd, kv):
+	"""DoSelect's result, from a cache entry"""
+	head = kv.get("_head",None)
+	if head:
+		if head>1:
+			yield e.description
+		else:
+			yield [x[0] for x in e.description]
+	if not e.rows and '_empty' not in kv:
+		raise NoData(cmd)
+	make_row = _row_factory(e, kv)
+	for r in e.rows:
+		r = e.row(r)
+		yield make_row(r) if make_row is not None else r
+
+_values_cache = PrepCache(maxsize=200)
+
 class DbPrep(object):
 	"""Base class for command prep"""
+	prep_cache = prep_cache
+
 	def __init__(self):
 		if hasattr(self.DB,'paramstyle'):
 			paramstyle = self.DB.paramstyle
 		else:
 			paramstyle = self.DB.DB.paramstyle
+		self.paramstyle = paramstyle
 		(self.arg_init, self.arg_do, self.arg_done) \
 			 = _parsers[paramstyle]
-	def prep(self,_cmd,**kwargs):
 
-		args = self.arg_init()
+	def compile(self,_cmd):
+		"""Return the (possibly cached) PrepTemplate for this statement"""
+		key = (_cmd,self.paramstyle)
+		tmpl = self.prep_cache.get(key)
+		if tmpl is not None:
+			return tmpl
+
+		names = self.arg_init()
 		def _prep(name):
-			return self.arg_do(name.group(1), args, kwargs)
-		
-		_cmd = re.sub(r"\$\{([a-zA-Z][a-zA-Z_0-9]*)\}",_prep,_cmd)
-		return self.arg_done(_cmd,args)
-		
+			return self.arg_do(name.group(1), names, _param_names)
+		sql = _param_re.sub(_prep,_cmd)
+		tmpl = PrepTemplate(sql, list(names), isinstance(names,dict), self.arg_done)
+		self.prep_cache.put(key,tmpl)
+		return tmpl
+
+	def prep(self,_cmd,**kwargs):
+		return self.compile(_cmd)(kwargs)
+
+	instrument = None
+	slow_log = None
+	result_cache = None
+
+	def _init_result_cache(self, kwargs):
+		"""result_cache: True, a ResultCache, or its maximum size"""
+		rc = kwargs.pop("result_cache",None)
+		if rc is True:
+			rc = ResultCache()
+		elif rc is not None and not isinstance(rc,ResultCache):
+			rc = ResultCache(int(rc)) if int(rc) else None
+		self.result_cache = rc
+
+	def _init_instrument(self, kwargs):
+		"""\
+			Pop the keywords for instrumentation and the slow query log.
+
+			instrument: a callable that gets a StmtEvent, or True for StmtStats
+			slow_query_ms: log statements which take at least this long
+			slow_query_log: a file name; default: the "sqlmix.slow" logger
+			slow_query_explain: also log the statement's plan
+			"""
+		instrument = kwargs.pop("instrument",None)
+		if instrument is True:
+			instrument = StmtStats()
+		self.instrument = instrument or None
+
+		ms = kwargs.pop("slow_query_ms",None)
+		path = kwargs.pop("slow_query_log",None)
+		explain = kwargs.pop("slow_query_explain",False)
+		if isinstance(explain,str):
+			explain = explain.lower() in ("1","true","yes","on")
+		if ms is not None:
+			self.slow_log = SlowLog(float(ms)/1000, path, explain)
+
+	def _probe(self, kind):
+		if self.instrument is None and self.slow_log is None:
+			return None
+		return _Probe(self.instrument, kind, self.DB.dbtype, self.slow_log, self._explain)
+
+	_explain = None
+
+	def compile_values(self,_cmd):
+		"""\
+			Split a single-row "INSERT … VALUES (…)" statement into its
+			head and the template for one row.
+
+			Returns None if the statement or the parameter style do not
+			allow concatenating rows.
+			"""
+		if not self.DB.multi_values or self.paramstyle not in ("qmark","format"):
+			return None
+		key = (_cmd,self.paramstyle)
+		res = _values_cache.get(key)
+		if res is None:
+			m = _values_re.match(_cmd)
+			if m is None or _param_re.search(m.group(1)) or not _single_group(m.group(2)):
+				res = False
+			else:
+				res = (m.group(1), self.compile(m.group(2)))
+			_values_cache.put(key,res)
+		return res or None
+
+	def values_stmts(self, values, args):
+		"""\
+			Yield (sql,args) tuples which insert these rows
+			with multi-row VALUES statements.
+			"""
+		head,tmpl = values
+		for batch in self.DB.values_batches(tmpl.sql, args):
+			sql = head + ",".join(repeat(tmpl.sql,len(batch)))
+			yield sql, tuple(v for a in batch for v in a)
+
+
+class _Waiter(object):
+	__slots__ = ("evt","conn","slot")
+	def __init__(self):
+		self.evt = Event()
+		self.conn = None
+		self.slot = False
+
+class ConnPool(object):
+	"""\
+		A bounded pool of database connections, shared by threads.
+
+		`connect` is called to open a new connection. At most `max_size`
+		connections exist at any time. Threads which need a connection
+		when all are in use wait in line, for at most `timeout` seconds.
+		Connections which have been idle for `idle` seconds are closed,
+		except for `min_size` of them.
+
+		`validate` checks a connection; it raises an exception if the
+		connection is dead. It is called on checkout when a connection has
+		been idle for `ping_idle` seconds, or always if `check` is set.
+		Dead connections are discarded and replaced.
+		"""
+	def __init__(self, connect, max_size=10, min_size=0, timeout=30, idle=300,
+			validate=None, ping_idle=None, check=False):
+		self.connect = connect
+		self.max_size = max_size
+		self.min_size = min_size
+		self.timeout = timeout
+		self.idle = idle
+		self.validate = validate
+		self.ping_idle = ping_idle
+		self.check = check
+		self.size = 0
+		self._idle = deque() # (conn,time), most recently used last
+		self._waiters = deque()
+		self._lock = Lock()
+
+	def get(self):
+		"""Check out a connection"""
+		with self._lock:
+			old = self._evict()
+			w = None
+			if self._waiters:
+				w = _Waiter()
+			elif self._idle:
+				conn,t = self._idle.pop()
+			elif self.size < self.max_size:
+				self.size += 1
+				conn = None
+			else:
+				w = _Waiter()
+			if w is not None:
+				self._waiters.append(w)
+		self._close(old)
+
+		if w is not None:
+			w.evt.wait(self.timeout)
+			with self._lock:
+				if not w.evt.is_set():
+					self._waiters.remove(w)
+					raise PoolTimeout(self.timeout)
+			if not w.slot:
+				return w.conn
+			conn = None
+
+		if conn is not None:
+			if self.validate is not None and (self.check or
+					(self.ping_idle is not None and time()-t >= self.ping_idle)):
+				try:
+					self.validate(conn)
+				except Exception:
+					self.discard(conn)
+					return self.get()
+		else:
+			try:
+				conn = self.connect()
+			except BaseException:
+				with self._lock:
+					self._free_slot()
+				raise
+		return conn
+
+	def put(self, conn):
+		"""Return a connection"""
+		with self._lock:
+			if self._waiters:
+				w = self._waiters.popleft()
+				w.conn = conn
+				w.evt.set()
+				return
+			self._idle.append((conn,time()))
+			old = self._evict()
+		self._close(old)
+
+	def discard(self, conn):
+		"""Close a connection which is not usable any more"""
+		self._close((conn,))
+		with self._lock:
+			self._free_slot()
+
+	def close(self):
+		"""Close all idle connections"""
+		with self._lock:
+			old = [c for c,t in self._idle]
+			self._idle.clear()
+			self.size -= len(old)
+		self._close(old)
+
+	def stats(self):
+		return dict(size=self.size, idle=len(self._idle), waiters=len(self._waiters),
+			max_size=self.max_size, min_size=self.min_size)
+
+	def _free_slot(self):
+		# lock held: a connection is gone, so let the next waiter open one
+		if self._waiters:
+			w = self._waiters.popleft()
+			w.slot = True
+			w.evt.set()
+		else:
+			self.size -= 1
+
+	def _evict(self):
+		# lock held: remove connections which have been idle for too long
+		old = []
+		t = time()-self.idle
+		while self._idle and self._idle[0][1] < t and self.size > self.min_size:
+			old.append(self._idle.popleft()[0])
+			self.size -= 1
+		return old
+
+	@staticmethod
+	def _close(conns):
+		for c in conns:
+			try:
+				c.close()
+			except Exception:
+				pass
+
+_read_re = re.compile(r"\s*(select|with|show|explain|describe|desc)\b", re.I)
+_locking_re = re.compile(r"\bfor\s+(update|share|no\s+key\s+update|key\s+share)\b|\block\s+in\s+share\s+mode\b", re.I)
+_dml_re = re.compile(r"\b(insert|update|delete|merge)\b", re.I)
+
+_read_cache = PrepCache(maxsize=200)
+
+def _is_read(cmd):
+	"""Can this statement run on a read replica?"""
+	res = _read_cache.get(cmd)
+	if res is None:
+		res = bool(_read_re.match(cmd)) and not _locking_re.search(cmd) \
+			and not (cmd.lstrip()[:4].lower() == "with" and _dml_re.search(cmd))
+		_read_cache.put(cmd,res)
+	return res
+
+def _load_config(kwargs):
+	"""Pop the 'config' keyword and return the parsed config file"""
+	try:
+		cffile = kwargs.pop('config')
+	except KeyError:
+		from os.path import expanduser as home
+		cffile = home("~/.sqlmix.conf")
+	if isinstance(cffile,str):
+		from configparser import ConfigParser
+		cfp = ConfigParser()
+		cfp.read(cffile)
+	else:
+		cfp = cffile
+	return cfp
+
+# keywords which select a server, and thus aren't copied to replicas
+_server_args = frozenset("host port database username password dbtype config cfg".split())
+
+def _replica_args(replicas, common, cfp, dbtype):
+	"""\
+		Keyword arguments for the replicas' Db objects. `replicas` is a
+		list of config sections or dicts (or a comma-separated string of
+		sections); `common` holds the keywords which apply to all.
+		"""
+	if isinstance(replicas,str):
+		replicas = [r.strip() for r in replicas.split(",") if r.strip()]
+	res = []
+	for r in replicas:
+		if isinstance(r,dict):
+			args = dict(r)
+		else:
+			if cfp is None:
+				cfp = _load_config({})
+			args = dict(cfp.items(r))
+		args.setdefault("dbtype",dbtype)
+		for k,v in common.items():
+			if k not in _server_args:
+				args.setdefault(k,v)
+		res.append(args)
+	return res
+
+class _ReplicaSet(object):
+	"""\
+		Routing state for read replicas: reads go to the replica with the
+		fewest outstanding requests (round-robin if that's a tie). Each replica's lag is checked every
+		`interval` seconds (by the caller, when `pick` says so); lagging or
+		failed replicas are skipped until the next check.
+		"""
+	def __init__(self, dbs, max_lag=30, interval=10):
+		self.dbs = dbs
+		self.max_lag = max_lag
+		self.interval = interval
+		n = len(dbs)
+		self.busy = [0]*n
+		self.reads = [0]*n
+		self.lag = [None]*n
+		self.down = [0.0]*n # skip until
+		self.checked = [0.0]*n
+		self._rr = 0 # round-robin among equally busy replicas
+		self._lock = Lock()
+
+	def pick(self):
+		"""\
+			Reserve a replica. Returns (index,check_lag), or (None,False)
+			if there is no usable replica.
+			"""
+		with self._lock:
+			now = time()
+			best = None
+			n = len(self.dbs)
+			self._rr = (self._rr+1) % n
+			for k in range(n):
+				i = (self._rr+k) % n
+				if self.down[i] > now:
+					continue
+				if best is None or self.busy[i] < self.busy[best]:
+					best = i
+			if best is None:
+				return None,False
+			self.busy[best] += 1
+			self.reads[best] += 1
+			due = self.checked[best]+self.interval <= now
+			if due:
+				self.checked[best] = now
+			return best,due
+
+	def done(self, i):
+		with self._lock:
+			self.busy[i] -= 1
+
+	def report(self, i, lag):
+		"""\
+			Record a replica's lag (None: unknown, or the replica failed).
+			Returns False, and releases the replica, if it is unusable.
+			"""
+		with self._lock:
+			self.lag[i] = lag
+			if lag is not None and lag <= self.max_lag:
+				self.down[i] = 0.0
+				return True
+			self.down[i] = time()+self.interval
+			self.busy[i] -= 1
+			return False
+
+	def stats(self):
+		with self._lock:
+			now = time()
+			return [dict(busy=self.busy[i], reads=self.reads[i], lag=self.lag[i],
+					up=self.down[i] <= now) for i in range(len(self.dbs))]
 
 class Db(DbPrep):
 	"""\
@@ -240,37 +1854,74 @@ class Db(DbPrep):
 	Internally, manages one back-end connection per thread.
 
 	Possible keywords: dbtype,host,port,database,username,password; config=inifile,cfg=section
+
+	Pooled mode: pool_size=N limits the number of connections. A thread
+	gets a connection from the pool when it starts a transaction and returns
+	it when committing or rolling back. Also pool_min (connections which
+	are kept when idle), pool_timeout (seconds to wait for a connection,
+	default 30), pool_idle (seconds until an idle connection is closed,
+	default 300), pool_check (ping every connection on checkout).
+
+	ping_idle: a connection which has been idle for this many seconds
+	(default 300) is checked with a cheap query before a new transaction
+	starts. Dead connections are replaced.
+
+	instrument: a callable which receives a StmtEvent for every statement,
+	or True to collect them in a StmtStats object (as `db.instrument`).
+	slow_query_ms, slow_query_log, slow_query_explain: see SlowLog.
+
+	result_cache: True, a ResultCache or its size, for _cache=ttl. Without
+	one, _cache is ignored.
+
+	replicas: read replicas, as a list of config sections or of dicts
+	with keyword arguments; the remaining keywords apply to all of them.
+	DoFn, DoSelect and DoColumns run plain SELECTs on the replica with the
+	fewest outstanding requests, unless this thread's transaction has
+	written something or `_primary=True` is passed. Replicas which lag
+	more than `replica_lag` seconds (default 30) are skipped; the lag is
+	checked every `replica_check` seconds (default 10).
 	"""
+	pool = None
+	replicas = None
+	ping_idle = 300
 
-	# These variables cache whether the database supports turning off
-	# autocommit, or setting the read wait timeout.
-	_set_ac1 = True
-	_set_ac2 = True
-	_set_timeout = True
-	_set_isolation = True
+	# default number of rows passed to `executemany` at once
+	chunk_size = 1000
+	# default number of rows fetched at once
+	batch_size = 100
 
 	def __init__(self, cfg=None, **kwargs):
+		common = dict(kwargs)
+		cfp = None
 		if cfg is not None:
-			try:
-				cffile = kwargs.pop('config')
-			except KeyError:
-				from os.path import expanduser as home
-				cffile = home("~/.sqlmix.conf")
-			if isinstance(cffile,str):
-				from configparser import ConfigParser
-				cfp = ConfigParser()
-				cfp.read(cffile)
-			else:
-				cfp = cffile
+			cfp = _load_config(kwargs)
 			args = dict(cfp.items(cfg))
 			args.update(kwargs)
 			kwargs = args
+		replicas = kwargs.pop("replicas",None)
+		max_lag = float(kwargs.pop("replica_lag",30))
+		interval = float(kwargs.pop("replica_check",10))
 
 		self._trace = kwargs.pop("trace",None)
+		self._init_instrument(kwargs)
+		self._init_result_cache(kwargs)
+		self.chunk_size = int(kwargs.pop("chunk_size",self.chunk_size))
+		self.batch_size = int(kwargs.pop("batch_size",self.batch_size))
+		pool_size = kwargs.pop("pool_size",None)
+		v = kwargs.pop("ping_idle",self.ping_idle)
+		self.ping_idle = float(v) if v is not None else None
+		pool_args = dict(check=bool(kwargs.pop("pool_check",False)))
+		for k,a,t in (("pool_min","min_size",int), ("pool_timeout","timeout",float), ("pool_idle","idle",float)):
+			v = kwargs.pop(k,None)
+			if v is not None:
+				pool_args[a] = t(v)
+
+		self.isolation = kwargs.pop("isolation",None)
 
 		dbtype = kwargs.pop("dbtype","mysql")
 		self.DB = _databases[dbtype](**kwargs)
 		self.DB.dbtype=dbtype
+		self.DB.isolation=self.isolation
 		if self._trace is not None:
 			self._trace("INIT",dbtype,kwargs)
 
@@ -284,59 +1935,246 @@ class Db(DbPrep):
 #			self.CArgs = (self.DB.DB.cursors.CursorNW,)
 #		else:
 		self.CArgs = ()
-		self.isolation = kwargs.pop("isolation",None)
 #
+		if pool_size is not None:
+			self.pool = ConnPool(self._connect, max_size=int(pool_size),
+				validate=self._ping, ping_idle=self.ping_idle, **pool_args)
+
+		if replicas:
+			common.pop("replicas",None)
+			if self.instrument is not None:
+				common["instrument"] = self.instrument
+			self.replicas = _ReplicaSet([Db(**a) for a in
+				_replica_args(replicas, common, cfp, dbtype)], max_lag, interval)
 
 		super(Db,self).__init__()
 		
 	def _conn(self, skip=False):
-		"""Create a connection to the underlying database."""
+		"""Return this thread's connection to the underlying database."""
 		
 		if not hasattr(self._c,"conn") or self._c.conn is None:
 			if skip: return None
 
-			Ex=None
-			r = self.DB.conn()
+			if self.pool is not None:
+				self._c.conn = self.pool.get()
+			else:
+				self._c.conn = self._connect()
+		elif not skip:
+			# starting a new transaction after being idle?
+			t = getattr(self._c,"idle",None)
+			if t is not None and self.ping_idle is not None and time()-t >= self.ping_idle:
+				self._c.idle = None
+				if not self.ping():
+					return self._conn()
+		if not skip:
+			self._c.idle = None
+		#r.cursor(*self.CArgs).execute('BEGIN')
+		return self._c.conn
 
-			if self._set_ac1:
-				try: r.setconnectoption(self.DB.DB.SQL.AUTOCOMMIT, self.DB.DB.SQL.AUTOCOMMIT_OFF)
-				except AttributeError: self._set_ac1 = False
-				else: self._set_ac2 = False
-			if self._set_ac2:
-				try:
-					if self.DB._cursor:
-						r.cursor(*self.CArgs).execute("SET AUTOCOMMIT=0")
-					else:
-						r.query("SET AUTOCOMMIT=0")
-				except Exception: self._set_ac2 = False
-		
-			if self._set_timeout:
-				try: 
-					if self.DB._cursor:
-						r.cursor(*self.CArgs).execute("SET WAIT_TIMEOUT=7200") # 2h
-					else:
-						r.query("SET WAIT_TIMEOUT=7200")
-				except Exception: self._set_timeout = False
-
-			if self._set_isolation and self.isolation:
-				try:
-					if self.DB._cursor:
-						r.cursor(*self.CArgs).execute("SET SESSION TRANSACTION ISOLATION LEVEL "+self.isolation)
-					else:
-						r.query("SET SESSION TRANSACTION ISOLATION LEVEL "+self.isolation)
-						
-				except Exception: self._set_isolation = False
-
-#			try:
-#				r.stringformat = self.DB.DB.UNICODE_STRINGFORMAT
-#				r.encoding = 'utf-8'
-#			except AttributeError:
-#				pass
+	def _ping(self, c):
+		self.DB.ping(c)
+		self._commit(c,"rollback")
+
+	def ping(self):
+		"""\
+		Check that this thread's connection is alive. Don't call this
+		within a transaction.
+
+		A dead connection is dropped; the next command will open a new
+		one. Returns False if the connection was dead (or there was none).
+		"""
+		c = self._conn(skip=True)
+		if c is None:
+			return False
+		try:
+			self._ping(c)
+		except Exception:
+			self._drop(c)
+			return False
+		return True
+
+	def replication_lag(self):
+		"""\
+		Seconds by which this database lags behind its primary; 0 if it's
+		not a replica, None if replication has stopped.
+		"""
+		if self.DB.lag_sql is None:
+			return 0
+		try:
+			row = self.DoFn(self.DB.lag_sql, _dict=True)
+		except NoData:
+			return 0
+		v = row.get(self.DB.lag_column)
+		return float(v) if v is not None else None
+
+	def _replica(self, _cmd, kv):
+		"""\
+		Reserve a replica for this statement; None: use the primary.
+		Also notes statements which write.
+		"""
+		if self.replicas is None and self.result_cache is None:
+			return None
+		if not _is_read(_cmd):
+			self._written(_cmd)
+			return None
+		rs = self.replicas
+		if rs is None or kv.pop("_primary",False) or getattr(self._c,"wrote",False):
+			return None
+		while True:
+			i,due = rs.pick()
+			if not due:
+				return i
+			try:
+				lag = rs.dbs[i].replication_lag()
+			except Exception:
+				lag = None
+			if rs.report(i, lag):
+				return i
+
+	def _on_replica(self, i, name, _cmd, kv):
+		rs = self.replicas
+		try:
+			res = getattr(rs.dbs[i],name)(_cmd, **kv)
+		except Exception as e:
+			if error_kind(e) != "conn_lost":
+				rs.done(i)
+				raise
+			rs.report(i, None)
+			return getattr(self,name)(_cmd, _primary=True, **kv)
+		if name == "DoSelect" and not kv.get("_callback"):
+			return self._replica_rows(i, res, _cmd, kv)
+		rs.done(i)
+		return res
+
+	def _replica_rows(self, i, rows, _cmd, kv):
+		"""\
+		Pass on the rows of a replica's DoSelect, then release the replica.
+		If its connection is lost before the first row, read from the primary.
+		"""
+		rs = self.replicas
+		lost = False
+		n = 0
+		try:
+			for r in rows:
+				n += 1
+				yield r
+		except Exception as e:
+			if n or error_kind(e) != "conn_lost":
+				raise
+			lost = True
+		finally:
+			if lost:
+				rs.report(i, None)
+			else:
+				rs.done(i)
+		if lost:
+			for r in self.DoSelect(_cmd, _primary=True, **kv):
+				yield r
+
+	def _written(self, sql):
+		"""\
+		This transaction writes to the tables of `sql`. Cached results
+		which read them are dropped when it commits.
+		"""
+		self._c.wrote = True
+		rc = self.result_cache
+		if rc is None:
+			return
+		d = getattr(self._c,"dirty",None)
+		if d is None:
+			d = self._c.dirty = set()
+			self.call_committed(self._flush_dirty, rc)
+			self.call_rolledback(self._flush_dirty, None)
+		tables = _tables(sql)
+		if tables:
+			d.update(tables)
+		else:
+			d.add(None) # unknown: everything
+
+	def _flush_dirty(self, rc):
+		d,self._c.dirty = self._c.dirty,None
+		if rc is not None and d:
+			rc.invalidate(() if None in d else d)
+
+	def _cache_get(self, _cmd, kv):
+		"""\
+		_cache=ttl: return the prepared command and its cache entry,
+		running the query if necessary. None: don't use the cache.
+		"""
+		ttl = kv.get("_cache",None)
+		rc = self.result_cache
+		if not ttl or rc is None or getattr(self._c,"wrote",False):
+			return None
+		cmd = self.prep(_cmd, **kv)
+		key,e = rc.lookup(cmd)
+		if e is None:
+			tables = _tables(cmd[0])
+			gen = rc.generation(tables)
+			it = self.DoSelect(_cmd, **_fill_args(kv))
+			e = rc.store(key, tables, gen, next(it), it, float(ttl))
+		return cmd,e
+
+	def _end_replicas(self):
+		"""End this thread's read transactions on the replicas"""
+		self._c.wrote = False
+		if self.replicas is None:
+			return
+		for i,db in enumerate(self.replicas.dbs):
+			if db._conn(skip=True) is None:
+				continue
+			try:
+				db.rollback()
+			except Exception:
+				with self.replicas._lock:
+					self.replicas.down[i] = time()+self.replicas.interval
+
+	def replica_stats(self):
+		"""Per replica: outstanding and total reads, last known lag, usable"""
+		return self.replicas.stats() if self.replicas is not None else []
+
+	def _drop(self, c):
+		"""Forget a broken connection."""
+		self._c.conn = None
+		if self.pool is not None:
+			self.pool.discard(c)
+		else:
+			ConnPool._close((c,))
 
+	def _connect(self):
+		"""Create a connection to the underlying database."""
+		r = self.DB.conn()
+
+		bad = _session_unsupported.setdefault(self.DB.dbtype,set())
+		stmts = [x for x in self.DB.session_sql() if x not in bad]
+		for x in stmts:
+			try:
+				if self.DB._cursor:
+					r.cursor(*self.CArgs).execute(x)
+				else:
+					r.query(x)
+			except Exception:
+				bad.add(x)
+		if stmts:
 			self._commit(r)
-			self._c.conn = r
-		#r.cursor(*self.CArgs).execute('BEGIN')
-		return self._c.conn
+		return r
+
+	def _release(self, c, ok=True):
+		"""\
+			The connection's transaction has ended. If that failed, roll
+			back and drop the connection if even that doesn't work.
+			Pooled mode: return the connection to the pool.
+			"""
+		if not ok:
+			try:
+				self._commit(c,"rollback")
+			except Exception:
+				self._drop(c)
+				return
+		if self.pool is None:
+			self._c.idle = time()
+			return
+		self._c.conn = None
+		self.pool.put(c)
 
 	def _commit(self,c,cmd="commit"):
 		if(hasattr(c,cmd)):
@@ -360,6 +2198,9 @@ class Db(DbPrep):
 		else:
 			if self._trace is not None:
 				self._trace("Close","NoConn","")
+		if self.replicas is not None:
+			for db in self.replicas.dbs:
+				db.close()
 
 	def commit(self):
 		"""\
@@ -372,7 +2213,13 @@ class Db(DbPrep):
 			self._trace("Commit","","")
 		c = self._conn(skip=True)
 		if c:
-			self._commit(c)
+			try:
+				self._commit(c)
+			except BaseException:
+				self._release(c, False)
+				raise
+			self._release(c)
+		self._end_replicas()
 
 		# callbacks
 		self._c.rolledback = None
@@ -395,7 +2242,13 @@ class Db(DbPrep):
 			self._trace("RollBack","","")
 		c = self._conn(skip=True)
 		if c:
-			self._commit(c,"rollback")
+			try:
+				self._commit(c,"rollback")
+			except BaseException:
+				self._drop(c)
+				raise
+			self._release(c)
+		self._end_replicas()
 
 		# cancel callbacks
 		self._c.committed = None
@@ -440,19 +2293,22 @@ class Db(DbPrep):
 		_dict is True: return a column/value dictionary instead of an array.
 		_dict is a type: as before, but use that. 
 		>>>	info = db.DoFn("select * from sometable where name=${myname}",myname="Fred", _dict=True)
+		_record is "namedtuple" or "slots": return a record with one
+		        attribute per column (a namedtuple or a __slots__ class).
+		_row is True: return a sqlmix.Row.
+		_primary is True: don't use a read replica.
+		_cache=ttl: use the result cache (see ResultCache), if the Db has
+		        one; the result may be up to `ttl` seconds old.
 
 		"""
-		conn=self._conn()
-		_cmd = self.prep(_cmd, **kv)
-		try:
-			if self.DB._cursor:
-				curs=conn.cursor(*self.CArgs)
-				curs.execute(*_cmd)
-			else:
-				curs=conn.query(*_cmd)
-		except:
-			fixup_error(_cmd)
-			raise
+		c = self._cache_get(_cmd, kv)
+		if c is not None:
+			return _cached_one(c[1], c[0], kv)
+		i = self._replica(_cmd, kv)
+		if i is not None:
+			return self._on_replica(i, "DoFn", _cmd, kv)
+		p = self._probe("DoFn")
+		curs,_cmd = self._execute(_cmd, kv, p)
 
 		if hasattr(curs,'fetchone'):
 			val = curs.fetchone()
@@ -460,39 +2316,29 @@ class Db(DbPrep):
 			val = None
 		else:
 			val = curs.rows.pop(0)
+		if p is not None:
+			p.fetched((val,) if val else ())
+			p.done()
 
 		if self._trace is not None:
 			self._trace("DoFn",_cmd,val)
 		if not val:
 			raise NoData(_cmd)
 
-		as_dict=kv.get("_dict",None)
-		if as_dict:
-			if as_dict is True:
-				as_dict = dict
-			names = map(lambda x:x[0], curs.description)
+		make_row = _row_factory(curs, kv)
 
 		if curs.fetchone() if hasattr(curs,'fetchone') else curs.rows:
 			raise ManyData(_cmd)
 
-		if as_dict:
-			val = as_dict(zip(names,val))
+		if make_row is not None:
+			val = make_row(val)
 		return val
 
 	def Do(self, _cmd, **kv):
 		"""Database-specific Do function"""
-		conn=self._conn()
-		_cmd = self.prep(_cmd, **kv)
-
-		try:
-			if self.DB._cursor:
-				curs=conn.cursor(*self.CArgs)
-				curs.execute(*_cmd)
-			else:
-				curs=conn.query(*_cmd)
-		except:
-			fixup_error(_cmd)
-			raise
+		self._written(_cmd)
+		p = self._probe("Do")
+		curs,_cmd = self._execute(_cmd, kv, p)
 
 		if isinstance(curs,(tuple,list)): # ultramysql
 			r = curs[1]
@@ -502,6 +2348,8 @@ class Db(DbPrep):
 			r = curs.lastrowid
 			if not r:
 				r = curs.rowcount
+		if p is not None:
+			p.done(rows=max(curs[0] if isinstance(curs,(tuple,list)) else curs.rowcount, 0))
 
 		if self._trace is not None:
 			self._trace("DoFn",_cmd,r)
@@ -509,6 +2357,202 @@ class Db(DbPrep):
 			raise NoData(_cmd)
 		return r
 
+	def DoMany(self, _cmd, _rows, **kv):
+		"""Run a statement for many rows, using the driver's `executemany`.
+
+		>>>	n = db.DoMany("insert into test1(a,b) values (${a},${b})", [dict(a="one",b="two"), ("three",None)])
+
+		Rows are dicts, or sequences whose values are assigned to the
+		statement's parameters in order of first appearance. Other keywords
+		supply values common to all rows. The statement is prepared once;
+		rows are consumed lazily.
+
+		Special keywords:
+
+		'_chunk': the number of rows passed to the driver at once
+		'_empty' is True: don't throw an error when no rows are affected
+		'_values' is False: don't rewrite a single-row INSERT to multi-row
+		                    VALUES lists (MySQL and SQLite do this by default)
+
+		Returns the total row count.
+		"""
+		conn=self._conn()
+		self._written(_cmd)
+		p = self._probe("DoMany")
+		tmpl = self.compile(_cmd)
+		chunk = kv.pop("_chunk",self.chunk_size)
+		empty = kv.pop("_empty",False)
+		values = None
+		if kv.pop("_values",True) and self.DB._cursor:
+			values = self.compile_values(_cmd)
+
+		if p is not None:
+			p.prepped(tmpl.sql, _cmd)
+		n = 0
+		try:
+			# building the chunks may fail too, e.g. on a short row
+			for args in _chunks(tmpl.rows(_rows,kv), chunk):
+				if p is not None:
+					p.start()
+				if values is not None:
+					r = 0
+					for stmt in self.values_stmts(values,args):
+						curs=conn.cursor(*self.CArgs)
+						curs.execute(*stmt)
+						r += curs.rowcount
+				elif self.DB._cursor:
+					curs=conn.cursor(*self.CArgs)
+					curs.executemany(tmpl.sql,args)
+					r = curs.rowcount
+				else:
+					r = 0
+					for a in args:
+						r += conn.query(tmpl.sql,a)[0]
+				if p is not None:
+					p.executed()
+				if r > 0:
+					n += r
+		except Exception as e:
+			fixup_error(tmpl.sql)
+			if p is not None:
+				p.done(e, n)
+			raise
+		if p is not None:
+			p.done(rows=n)
+
+		if self._trace is not None:
+			self._trace("DoMany",tmpl.sql,n)
+		if n == 0 and not empty:
+			raise NoData(tmpl.sql)
+		return n
+
+	def CopyIn(self, _table, _columns, _rows, **kv):
+		"""Bulk-load rows into a table.
+
+		>>>	n = db.CopyIn("test1", ("a","b"), (("row %d" % i, None) for i in range(1000000)))
+
+		Rows are sequences of values, in the order of `_columns`. They are
+		encoded incrementally, so a generator is loaded in constant memory.
+
+		PostgreSQL uses COPY … FROM STDIN. MySQL uses LOAD DATA LOCAL
+		INFILE, via a temporary file, if the connection has been opened with
+		`local_infile=1`. Otherwise rows are inserted with DoMany; keywords
+		are passed to it.
+
+		Returns the number of rows loaded.
+		"""
+		conn=self._conn()
+		self._written("insert into "+_table)
+		p = self._probe("CopyIn")
+		_columns = list(_columns)
+		if p is not None:
+			p.prepped(_table)
+		try:
+			n = self.DB.copy_in(conn, _table, _columns, _rows)
+		except Exception as e:
+			fixup_error(_table)
+			if p is not None:
+				p.done(e)
+			raise
+		if n is None:
+			kv.setdefault("_empty",True)
+			cmd = "insert into %s(%s) values (%s)" % (_table, ",".join(_columns),
+				",".join("${c%d}" % i for i in range(len(_columns))))
+			return self.DoMany(cmd, _rows, **kv)
+		if p is not None:
+			p.executed()
+			p.done(rows=n)
+
+		if self._trace is not None:
+			self._trace("CopyIn",_table,n)
+		return n
+
+	def CopyOut(self, _cmd, _file, **kv):
+		"""Write the result of a query to a file, in COPY text format.
+
+		>>>	with open("/tmp/dump.txt","wb") as f:
+		...		n = db.CopyOut("select id,a,b from test1 where id>${id}", f, id=10)
+
+		The format is tab-separated; NULL is written as \\N. Binary files get
+		UTF-8 encoded data.
+
+		PostgreSQL uses COPY (…) TO STDOUT. Other databases stream the rows
+		from DoSelect.
+
+		Returns the number of rows written.
+		"""
+		conn=self._conn()
+		p = self._probe("CopyOut")
+		cmd = self.prep(_cmd, **kv)
+		if p is not None:
+			p.prepped(cmd, _cmd)
+		try:
+			n = self.DB.copy_out(conn, cmd, _file)
+		except Exception as e:
+			fixup_error(cmd)
+			if p is not None:
+				p.done(e)
+			raise
+		if n is not None:
+			if p is not None:
+				p.executed()
+				p.done(rows=n)
+		else:
+			text = isinstance(_file, io.TextIOBase)
+			n = 0
+			kv["_empty"] = True
+			kv.setdefault("_store",0)
+			for row in self._DoSelect(_cmd, **kv):
+				line = _copy_line(row)
+				_file.write(line if text else line.encode("utf-8"))
+				n += 1
+
+		if self._trace is not None:
+			self._trace("CopyOut",cmd,n)
+		return n
+
+	def DoColumns(self, _cmd, **kv):
+		"""Select rows and return them as one array per column.
+
+		>>>	cols = db.DoColumns("select id,price from sometable where name like ${pattern}", pattern='f%d')
+		>>>	total = sum(cols["price"])
+
+		The result is a dictionary which maps column names to arrays.
+		Columns holding only numbers become NumPy int64/float64 arrays, or
+		array.array('q'/'d') if NumPy is not available; other columns are
+		NumPy object arrays or lists. No per-row objects are created.
+
+		Special keywords:
+
+		'_batch', '_store', '_empty': as with DoSelect
+		'_numpy' is False: don't use NumPy
+		'_primary' is True: don't use a read replica
+
+		"""
+		i = self._replica(_cmd, kv)
+		if i is not None:
+			return self._on_replica(i, "DoColumns", _cmd, kv)
+		p = self._probe("DoColumns")
+		curs,_cmd = self._select(_cmd, kv, p)
+		res = _Columns([x[0] for x in curs.description])
+		try:
+			for rows in _fetch_batches(curs, kv.get("_batch",self.batch_size), p):
+				res.add(rows)
+		except Exception as e:
+			if p is not None:
+				p.error = type(e).__name__
+			raise
+		finally:
+			self._close_select(curs, kv)
+			if p is not None:
+				p.done()
+
+		if self._trace is not None:
+			self._trace("DoColumns",_cmd,res.n)
+		if not res.n and '_empty' not in kv:
+			raise NoData(_cmd)
+		return res.result(kv.get("_numpy",True))
+
 	def DoSelect(self, _cmd, **kv):
 		"""Select one or more rows from a database.
 
@@ -522,7 +2566,9 @@ class Db(DbPrep):
 		
 		Special keywords:
 
-		'_store' is 0: force saving the result on the server
+		'_store' is 0: force saving the result on the server, and stream it
+		               (MySQL: unbuffered cursor; PostgreSQL: named cursor;
+		               SQLite always steps through the result on demand)
 		'_store' is 1: force saving the result on the client
 		Otherwise:     save on the server if the backend supports multiple
 		               concurrent cursors on a single connection
@@ -530,17 +2576,35 @@ class Db(DbPrep):
 		'_head' is 1: first return is headers as text
 		'_head' is 2: first return is DB header tuples
 
+		'_batch': the number of rows to fetch from the driver at once
+
 		'_dict' is True: yield entries as dictionary instead of list
 		'_dict' is a type: as before, but use that. 
+		'_record' is "namedtuple" or "slots": yield records with one
+		          attribute per column; they need much less memory than
+		          dicts
+		'_row' is True: yield sqlmix.Row objects, which share one column
+		       index and don't copy the driver's row
 		'_empty' is True: don't throw an error when no data are returned
 		'_callback': pass rows to a procedure (either as arguments or as
 		             keywords, depending on _dict), return row count
+		'_primary' is True: don't use a read replica
+		'_cache'=ttl: use the result cache, as with DoFn. The query runs
+		              right away, not when the result is iterated.
 
 		"""
+		c = self._cache_get(_cmd, kv)
+		if c is not None:
+			rows = _cached_rows(c[1], c[0], kv)
+		else:
+			i = self._replica(_cmd, kv)
+			if i is not None:
+				return self._on_replica(i, "DoSelect", _cmd, kv)
+			rows = self._DoSelect(_cmd, **kv)
 		cb = kv.get('_callback',None)
 		if cb:
 			n = 0
-			for x in self._DoSelect(_cmd, **kv):
+			for x in rows:
 				if kv.get('_dict',None):
 					cb(**x)
 				else:
@@ -548,70 +2612,142 @@ class Db(DbPrep):
 				n += 1
 			return n
 		else:
-			return self._DoSelect(_cmd, **kv)
+			return rows
 
-	def _DoSelect(self, _cmd, **kv):
+	def _explain(self, cmd):
+		"""Return the plan of a statement, using the current connection"""
+		sql = self.DB.explain_sql(cmd[0])
+		c = self._conn(skip=True)
+		if sql is None or c is None or not self.DB._cursor:
+			return None
+		sp = self.DB.explain_savepoint
+		try:
+			curs = c.cursor(*self.CArgs)
+			if sp:
+				curs.execute("SAVEPOINT sqlmix_explain")
+			try:
+				curs.execute(sql, *cmd[1:])
+				res = [list(r) for r in curs.fetchall()]
+			except Exception:
+				if sp:
+					curs.execute("ROLLBACK TO SAVEPOINT sqlmix_explain")
+				raise
+			if sp:
+				curs.execute("RELEASE SAVEPOINT sqlmix_explain")
+			return res
+		except Exception as e:
+			return "%s: %s" % (type(e).__name__, e)
+
+	def _execute(self, _cmd, kv, probe=None):
+		"""Run a statement; return the cursor and the prepared command"""
+		conn=self._conn()
+		src,_cmd = _cmd,self.prep(_cmd, **kv)
+		if probe is not None:
+			probe.prepped(_cmd, src)
+		try:
+			if self.DB._cursor:
+				curs=conn.cursor(*self.CArgs)
+				curs.execute(*_cmd)
+			else:
+				curs=conn.query(*_cmd)
+		except Exception as e:
+			fixup_error(_cmd)
+			if probe is not None:
+				probe.done(e)
+			raise
+		if probe is not None:
+			probe.executed()
+		return curs,_cmd
+
+	def _select(self, _cmd, kv, probe=None):
+		"""Run a query; return the cursor and the prepared command"""
 		conn=self._conn()
 
 		store=kv.get("_store",self.DB._store)
 
 		if self.DB._cursor:
-			if store:
-				curs=conn.cursor(*self.CArgs)
-			elif self.DB.dbtype == "mysql":
-				curs=conn.cursor(self.DB.DB.cursors.SSCursor)
-			else:
-				curs=conn.cursor(*self.CArgs)
-		_cmd = self.prep(_cmd, **kv)
+			curs=self.DB.cursor(conn, store, kv.get("_batch",self.batch_size), self.CArgs)
+		src,_cmd = _cmd,self.prep(_cmd, **kv)
+		if probe is not None:
+			probe.prepped(_cmd, src)
 		try:
 			if self.DB._cursor:
 				curs.execute(*_cmd)
 			else:
 				curs = conn.query(*_cmd)
-		except:
+		except Exception as e:
 			fixup_error(_cmd)
+			if probe is not None:
+				probe.done(e)
 			raise
+		if probe is not None:
+			probe.executed()
+		return curs,_cmd
 
-	
-		head = kv.get("_head",None)
-		if head:
-			if head>1:
-				yield curs.description
-			else:
-				yield map(lambda x:x[0], curs.description)
-
-		as_dict=kv.get("_dict",None)
-		if as_dict:
-			if as_dict is True:
-				as_dict = dict
-			names = map(lambda x:x[0], curs.description)
+	def _close_select(self, curs, kv):
+		"""Release a streaming cursor"""
+		if self.DB._cursor and not kv.get("_store",self.DB._store):
+			curs.close()
 
-		val = curs.fetchone() if hasattr(curs,'fetchone') else curs.rows.pop(0) if curs.rows else None
-		if not val:
-			if self._trace is not None:
-				self._trace("DoSelect",_cmd,None)
+	def _DoSelect(self, _cmd, **kv):
+		p = self._probe("DoSelect")
+		curs,_cmd = self._select(_cmd, kv, p)
+		try:
+			head = kv.get("_head",None)
+			if head:
+				if head>1:
+					yield curs.description
+				else:
+					yield [x[0] for x in curs.description]
 
-			if '_empty' not in kv:
-				raise NoData(_cmd)
+			make_row = _row_factory(curs, kv)
 
-		n=0
-		while val is not None:
-			n += 1
-			if as_dict:
-				yield as_dict(zip(names,val))
-			else:
-				yield val[:]
-				# need to copy because the array may be re-used
-				# internally by the database driver, but the consumer
-				# might want to store/modify it
-			val = curs.fetchone() if hasattr(curs,'fetchone') else curs.rows.pop(0) if curs.rows else None
+			n=0
+			for val in _fetch_rows(curs, kv.get("_batch",self.batch_size), p):
+				n += 1
+				if make_row is not None:
+					yield make_row(val)
+				else:
+					yield val[:]
+					# need to copy because the array may be re-used
+					# internally by the database driver, but the consumer
+					# might want to store/modify it
+
+			if not n:
+				if self._trace is not None:
+					self._trace("DoSelect",_cmd,None)
+
+				if '_empty' not in kv:
+					raise NoData(_cmd)
+		except Exception as e:
+			if p is not None and not isinstance(e,NoData):
+				p.error = type(e).__name__
+			raise
+		finally:
+			self._close_select(curs, kv)
+			if p is not None:
+				p.done()
 
 		if self._trace is not None:
 			self._trace("DoSelect",_cmd,n)
 
 
-	def __call__(self):
-		return self
+	def __call__(self, job=None, retry=0):
+		"""\
+		Without arguments, return self (for "with db(): ...").
+
+		Otherwise, run job(db) in a transaction and return its result.
+		`retry` is a number of retries, or a Retry policy; only deadlocks,
+		serialization failures and similar errors are retried.
+		"""
+		if job is None:
+			if retry:
+				raise RuntimeError("You can't use 'retry' without something to call")
+			return self
+		for attempt in Retry.get(retry).attempts(self):
+			with attempt:
+				res = job(self)
+		return res
 
 	def __enter__(self):
 		return self
@@ -6,7 +6,7 @@ from __future__ import generators,absolute_import
 This class is an anyio-compatible frontend to sqlmix.Db.
 
 It has the same interface, except that all Do* methods return a future.
-Internally it works by wrapping trio-mysql or aiopg (asyncio backend only).
+Internally it works by wrapping trio-mysql or asyncpg (asyncio backend only).
 
  >> import sqlmix.async_ as sqlmix
  >> dbi = sqlmix.DbPool([args of sqlmix.Db])
@@ -43,9 +43,15 @@ import string
 import re
 import sys
 from traceback import print_exc
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, AsyncExitStack
+from collections import deque, OrderedDict
+from threading import Thread
+from queue import Queue, Empty
 
 import anyio
+import anyio.lowlevel
+import anyio.from_thread
+from itertools import count
 
 import logging
 logger = logging.getLogger(__name__)
@@ -54,9 +60,12 @@ __all__ = ('DbPool','NoData','ManyData')
 
 _DEBUG = False
 
-def _call(r,p,a,k):
-    """Drop the first argument (i.e. lose the Deferred result)"""
-    return p(*a,**k)
+async def _call(p,a,k):
+    """Call a procedure, which may or may not be async"""
+    res = p(*a,**k)
+    if hasattr(res,'__await__'):
+        res = await res
+    return res
 
 def _print_error(f):
     f.printTraceback(file=sys.stderr)
@@ -103,6 +112,85 @@ def debug(*a):
 #                if v is not None:
 #                    setattr(self,f,v)
 
+async def _fetch_batches(curs, batch, probe=None):
+    """Iterate over a result, fetching `batch` rows at a time"""
+    if hasattr(curs,'fetchmany'):
+        while True:
+            if probe is not None:
+                probe.start()
+            rows = await curs.fetchmany(batch)
+            if probe is not None:
+                probe.fetched(rows)
+            if not rows:
+                return
+            yield rows
+    elif curs.rows:
+        if probe is not None:
+            probe.fetched(curs.rows)
+        yield curs.rows
+
+async def _fetch_rows(curs, batch, probe=None):
+    """Iterate over a result's rows, fetching `batch` rows at a time"""
+    async for rows in _fetch_batches(curs, batch, probe):
+        for row in rows:
+            yield row
+
+_cursor_seq = count(1)
+
+class _DeclaredCursor:
+    """\
+    Stream a query's result through a server-side cursor
+    (DECLARE … / FETCH FORWARD …). This works with any PostgreSQL driver,
+    within a transaction.
+    """
+    def __init__(self, curs, batch):
+        self.curs = curs
+        self.batch = batch
+        self.name = "sqlmix_%d" % next(_cursor_seq)
+        self.rows = None
+
+    async def execute(self, cmd, args=None):
+        await self.curs.execute("DECLARE "+self.name+" NO SCROLL CURSOR FOR "+cmd, args)
+        # fetch the first batch now, so that the description is known
+        self.rows = await self._fetch(self.batch)
+
+    @property
+    def description(self):
+        return self.curs.description
+
+    async def _fetch(self, n):
+        await self.curs.execute("FETCH FORWARD %d FROM %s" % (n,self.name))
+        return await self.curs.fetchall()
+
+    async def fetchmany(self, n):
+        if self.rows is not None:
+            rows,self.rows = self.rows,None
+            return rows
+        return await self._fetch(n)
+
+    async def aclose(self):
+        try:
+            await self.curs.execute("CLOSE "+self.name)
+        finally:
+            self.curs.close()
+
+    def close(self):
+        self.curs.close()
+
+async def _ping_sql(conn):
+    """Check that a connection is alive; raise an exception if not"""
+    async with conn.cursor() as curs:
+        await curs.execute("SELECT 1")
+        await curs.fetchall()
+
+class _Waiter:
+    """A task waiting for a connection, or for the right to open one"""
+    conn = None
+    slot = False
+
+    def __init__(self):
+        self.evt = anyio.Event()
+
 class ConnEvt:
     scope=None
     db=None
@@ -119,6 +207,11 @@ class ConnEvt:
 
 class _db_mysql(sqlmix.db_data):
     port=3306
+    declare_cursor = False
+    multi_values = True
+    values_bytes = sqlmix._db_mysql.values_bytes
+    lag_sql = sqlmix._db_mysql.lag_sql
+    lag_column = sqlmix._db_mysql.lag_column
     def __init__(self, **kwargs):
         self.DB = __import__("trio_mysql")
         super().__init__(**kwargs)
@@ -138,20 +231,450 @@ class _db_mysql(sqlmix.db_data):
         db._tg.start_soon(self._conn, evt)
         return evt
 
+    async def ping(self, conn):
+        await conn.ping(reconnect=False)
+
+
+class _PgCursor:
+    """\
+    A DB-API style cursor on a _PgConn. Results are fetched (and decoded
+    from the binary protocol by asyncpg) when the statement runs.
+    """
+    description = None
+    rowcount = -1
+    lastrowid = None
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *tb):
+        pass
+
+    def __await__(self):
+        # `await conn.cursor()` works too
+        yield from ()
+        return self
+
+    async def execute(self, sql, args=None):
+        stmt = await self.conn._statement(sql)
+        try:
+            rows = await stmt.fetch(*(args or ()))
+        except self.conn.pg.exceptions.InvalidCachedStatementError:
+            # the schema has changed; the transaction is aborted anyway
+            self.conn.stmts.pop(sql,None)
+            raise
+        self.rows = [tuple(r) for r in rows]
+        self.description = tuple((a.name, a.type.oid, None,None,None,None,None) for a in stmt.get_attributes()) or None
+        status = (stmt.get_statusmsg() or "").rsplit(" ",1)[-1]
+        self.rowcount = int(status) if status.isdigit() else -1
+
+    async def executemany(self, sql, args):
+        """All rows are sent in one go; asyncpg pipelines them"""
+        stmt = await self.conn._statement(sql)
+        args = list(args)
+        await stmt.executemany(args)
+        # asyncpg doesn't report the number of affected rows
+        self.rowcount = len(args)
+        self.rows = []
+        self.description = None
+
+    async def fetchall(self):
+        rows,self.rows = self.rows,[]
+        return rows
+
+    async def aclose(self):
+        self.rows = []
+
+    def close(self):
+        self.rows = []
+
+class _PgStream:
+    """Stream a result through an asyncpg cursor (a server-side portal)"""
+    description = None
+    rowcount = -1
+
+    def __init__(self, conn, batch):
+        self.conn = conn
+        self.batch = batch
+        self.curs = None
+        self.rows = None
+
+    async def execute(self, sql, args=None):
+        stmt = await self.conn._statement(sql)
+        self.description = tuple((a.name, a.type.oid, None,None,None,None,None) for a in stmt.get_attributes()) or None
+        self.curs = await stmt.cursor(*(args or ()))
+        # fetch the first batch now, like _DeclaredCursor
+        self.rows = await self.curs.fetch(self.batch)
+
+    async def fetchmany(self, n):
+        if self.rows is not None:
+            rows,self.rows = self.rows,None
+        else:
+            rows = await self.curs.fetch(n)
+        return [tuple(r) for r in rows]
+
+    async def aclose(self):
+        # the portal goes away when the transaction ends
+        self.curs = None
+
+    def close(self):
+        self.curs = None
+
+class _PgConn:
+    """\
+    Wrap an asyncpg connection: start a transaction before the first
+    statement, keep an LRU cache of prepared statements.
+    """
+    _sqlmix_scope = None
+
+    def __init__(self, pg, conn, cache_size, begin):
+        self.pg = pg
+        self.conn = conn
+        self.cache_size = cache_size
+        self.begin = begin
+        self.stmts = OrderedDict()
+        self.in_tx = False
+
+    def cursor(self):
+        return _PgCursor(self)
+
+    def stream_cursor(self, batch):
+        return _PgStream(self, batch)
+
+    async def _statement(self, sql):
+        if not self.in_tx:
+            await self.conn.execute(self.begin)
+            self.in_tx = True
+        stmt = self.stmts.get(sql)
+        if stmt is not None:
+            self.stmts.move_to_end(sql)
+            return stmt
+        stmt = await self.conn.prepare(sql)
+        if self.cache_size:
+            self.stmts[sql] = stmt
+            if len(self.stmts) > self.cache_size:
+                self.stmts.popitem(last=False)
+        return stmt
+
+    async def commit(self):
+        if self.in_tx:
+            self.in_tx = False
+            await self.conn.execute("COMMIT")
+
+    async def rollback(self):
+        if self.in_tx:
+            self.in_tx = False
+            await self.conn.execute("ROLLBACK")
+
+    def close(self):
+        self.conn.terminate()
 
 class _db_postgres(sqlmix.db_data):
+    """\
+    PostgreSQL via asyncpg (asyncio only). Statements are prepared once
+    per connection and kept in an LRU cache of `statement_cache` entries;
+    DoMany sends all its rows in one pipelined batch.
+    """
+    port = 5432
+    # stream with _store=0
+    declare_cursor = True
+    paramstyle = 'dollar'
+    lag_sql = sqlmix._db_postgres.lag_sql
+    explain_savepoint = True
+    statement_cache = 256
+
     def __init__(self, **kwargs):
-        self.DB = __import__("aiopg")
+        self.DB = __import__("asyncpg")
+        self.statement_cache = int(kwargs.pop('statement_cache',self.statement_cache))
         super().__init__(**kwargs)
+        self.kwargs.pop('charset',None)
+        self.kwargs.pop('use_unicode',None)
 
-    async def conn(self, db):
-        res = await self.DB.connect(self.database)
-        res._sqlmix_scope = None
-        return res
+    async def _conn(self, evt):
+        with anyio.CancelScope(shield=True) as sc:
+            evt.scope=sc
+            conn = await self.DB.connect(database=self.database, host=self.host, user=self.username, password=self.password, port=self.port, **self.kwargs)
+            try:
+                begin = "BEGIN"
+                if self.isolation:
+                    begin += " ISOLATION LEVEL "+self.isolation
+                res = _PgConn(self.DB, conn, self.statement_cache, begin)
+                res._sqlmix_scope = sc
+                evt.set(res)
+                await anyio.sleep_forever()
+            finally:
+                with anyio.move_on_after(2, shield=True) as cs:
+                    await conn.close()
+                if cs.cancelled_caught:
+                    conn.terminate()
+
+    def conn(self, db):
+        evt = ConnEvt()
+        db._tg.start_soon(self._conn, evt)
+        return evt
+
+    async def ping(self, conn):
+        await conn.conn.fetchval("SELECT 1")
+
+class _SqlJob:
+    __slots__ = ("proc","args","evt","result","error")
+
+    def __init__(self, proc, args):
+        self.proc = proc
+        self.args = args
+        self.evt = anyio.Event()
+        self.result = None
+        self.error = None
+
+def _wake(jobs):
+    for j in jobs:
+        j.evt.set()
+
+class _SqliteCursor:
+    """\
+    A cursor on a _SqliteConn. `execute` fetches the whole result in the
+    same trip to the worker thread.
+    """
+    description = None
+    rowcount = -1
+    lastrowid = None
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *tb):
+        pass
+
+    def __await__(self):
+        # `await conn.cursor()` works too
+        yield from ()
+        return self
+
+    def _run(self, sql, args, many):
+        curs = self.conn.conn.cursor()
+        try:
+            if many:
+                curs.executemany(sql, args)
+            else:
+                curs.execute(sql, args)
+            rows = curs.fetchall() if curs.description else []
+            return curs.description, curs.rowcount, curs.lastrowid, rows
+        finally:
+            curs.close()
+
+    async def execute(self, sql, args=()):
+        await self.conn._will_run(sql)
+        self.description,self.rowcount,self.lastrowid,self.rows = \
+            await self.conn._do(self._run, sql, args or (), False)
+
+    async def executemany(self, sql, args):
+        await self.conn._will_run(sql)
+        self.description,self.rowcount,self.lastrowid,self.rows = \
+            await self.conn._do(self._run, sql, list(args), True)
+
+    async def fetchall(self):
+        rows,self.rows = self.rows,[]
+        return rows
+
+    async def aclose(self):
+        self.rows = []
+
+    def close(self):
+        self.rows = []
+
+class _SqliteStream:
+    """Step through a result in the worker thread, `batch` rows per trip"""
+    description = None
+    rowcount = -1
+
+    def __init__(self, conn, batch):
+        self.conn = conn
+        self.batch = batch
+        self.curs = None
+        self.rows = None
+
+    def _start(self, sql, args):
+        self.curs = curs = self.conn.conn.cursor()
+        curs.execute(sql, args)
+        return curs.description, curs.fetchmany(self.batch)
+
+    async def execute(self, sql, args=()):
+        await self.conn._will_run(sql)
+        self.description,self.rows = await self.conn._do(self._start, sql, args or ())
+
+    async def fetchmany(self, n):
+        if self.rows is not None:
+            rows,self.rows = self.rows,None
+            return rows
+        return await self.conn._do(self.curs.fetchmany, n)
+
+    async def aclose(self):
+        if self.curs is not None:
+            curs,self.curs = self.curs,None
+            await self.conn._do(curs.close)
+
+    def close(self):
+        if self.curs is not None:
+            self.conn._post(self.curs.close)
+            self.curs = None
+
+class _SqliteConn:
+    """\
+    A sqlite3 connection which lives in its own worker thread.
+
+    Requests are queued; the thread runs whatever has accumulated, then
+    wakes all their callers with a single call into the event loop.
+    Statements which write take the database's writer lock first and
+    keep it until the transaction ends.
+    """
+    _sqlmix_scope = None
+    writing = False
+
+    def __init__(self, db):
+        self.db = db
+        self.conn = None
+        self.queue = Queue()
+        self.token = anyio.lowlevel.current_token()
+
+    def cursor(self):
+        return _SqliteCursor(self)
+
+    def stream_cursor(self, batch):
+        return _SqliteStream(self, batch)
+
+    def _post(self, proc, *args):
+        """Queue a job; nobody waits for it"""
+        self.queue.put(_SqlJob(proc,args))
+
+    async def _do(self, proc, *args):
+        """Run a job in the worker thread"""
+        j = _SqlJob(proc,args)
+        self.queue.put(j)
+        await j.evt.wait()
+        if j.error is not None:
+            raise j.error
+        return j.result
+
+    def _run(self):
+        q = self.queue
+        while True:
+            jobs = [q.get()]
+            while True:
+                try:
+                    jobs.append(q.get_nowait())
+                except Empty:
+                    break
+            for j in jobs:
+                if j is None:
+                    continue
+                try:
+                    j.result = j.proc(*j.args)
+                except BaseException as e:
+                    j.error = e
+            done = [j for j in jobs if j is not None]
+            if done:
+                try:
+                    anyio.from_thread.run_sync(_wake, done, token=self.token)
+                except RuntimeError:
+                    pass # the event loop is gone
+            if None in jobs:
+                if self.conn is not None:
+                    self.conn.close()
+                return
+
+    def _connect(self):
+        db = self.db
+        self.conn = db.DB.connect(db.database, check_same_thread=False, timeout=db.busy_timeout)
+        if db.wal:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+
+    async def _will_run(self, sql):
+        if self.writing or sqlmix._is_read(sql):
+            return
+        with anyio.move_on_after(self.db.busy_timeout):
+            await self.db.writer.acquire()
+            self.writing = True
+            return
+        raise self.db.DB.OperationalError("database is locked (waiting for the writer)")
+
+    def _done_writing(self):
+        if self.writing:
+            self.writing = False
+            self.db.writer.release()
+
+    async def commit(self):
+        try:
+            await self._do(self.conn.commit)
+        finally:
+            self._done_writing()
+
+    async def rollback(self):
+        try:
+            await self._do(self.conn.rollback)
+        finally:
+            self._done_writing()
+
+    def close(self):
+        self._done_writing()
+        self.queue.put(None)
+
+class _db_sqlite(sqlmix._db_sqlite):
+    """\
+    SQLite, with one worker thread per connection. File databases use
+    WAL mode, so readers don't block each other or the writer; writers
+    take turns. ":memory:" databases are private to their connection,
+    so the pool is limited to one of those.
+    """
+    _store = 1
+    # stream with _store=0
+    declare_cursor = True
+    max_conns = None
+    busy_timeout = 5.0
+
+    def __init__(self, **kwargs):
+        self.busy_timeout = float(kwargs.pop('busy_timeout',self.busy_timeout))
+        wal = kwargs.pop('wal',True)
+        if isinstance(wal,str):
+            wal = wal.lower() in ("1","true","yes","on")
+        super().__init__(**kwargs)
+        self.wal = wal and self.database not in (None,"",":memory:")
+        if self.database in (None,"",":memory:"):
+            self.max_conns = 1
+        self.writer = anyio.Semaphore(1)
+
+    async def _conn(self, evt):
+        with anyio.CancelScope(shield=True) as sc:
+            evt.scope=sc
+            res = _SqliteConn(self)
+            Thread(target=res._run, name="sqlite "+str(self.database), daemon=True).start()
+            try:
+                await res._do(res._connect)
+                res._sqlmix_scope = sc
+                evt.set(res)
+                await anyio.sleep_forever()
+            finally:
+                res.close()
+
+    def conn(self, db):
+        evt = ConnEvt()
+        db._tg.start_soon(self._conn, evt)
+        return evt
+
+    async def ping(self, conn):
+        await conn._do(conn.conn.execute, "SELECT 1")
 
 _databases = {
     "mysql": _db_mysql,
     "postgres": _db_postgres,
+    "sqlite": _db_sqlite,
 }
 
 class CtxObj:
@@ -169,12 +692,35 @@ class CtxObj:
 class Db(CtxObj, sqlmix.DbPrep):
     """\
     Manage a pool of database connections.
+
+    Keywords, as for sqlmix.Db: pool_size (the maximum number of
+    connections; default: unlimited), pool_min (connections which are
+    opened when the pool starts and kept when idle), pool_timeout (how
+    long to wait for a connection before raising PoolTimeout).
+    Tasks which wait for a connection are served in order.
+
+    Idle connections are pinged every ping_idle seconds (default 300);
+    with pool_check, every connection is also pinged on checkout.
+    Dead connections are discarded and replaced.
+
+    instrument, slow_query_ms, slow_query_log, slow_query_explain,
+    replicas, replica_lag, replica_check: as for sqlmix.Db. Each replica
+    has its own pool. Within a transaction, reads go to a replica until
+    the transaction writes.
     """
     timeout = 70 # one minute plus
     cleaner = None
     _trace = None
     db = None
     id_seq = 0
+    max_size = None
+    min_size = 0
+    acquire_timeout = None
+    ping_idle = sqlmix.Db.ping_idle
+    ping_timeout = 10
+    check = False
+    chunk_size = sqlmix.Db.chunk_size
+    batch_size = sqlmix.Db.batch_size
 
     def __init__(self,cfg=None, dbtype='mysql', _timeout=None, **kwargs):
         """\
@@ -182,33 +728,46 @@ class Db(CtxObj, sqlmix.DbPrep):
         SQL commands.
         """
 
+        common = dict(kwargs)
+        cfp = None
         if cfg is not None:
-            try:
-                cffile = kwargs.pop('config')
-            except KeyError:
-                from os.path import expanduser as home
-                cffile = home("~/.sqlmix.conf")
-            if isinstance(cffile,str):
-                from configparser import ConfigParser
-                cfp = ConfigParser()
-                cfp.read(cffile)
-            else:
-                cfp = cffile
+            cfp = sqlmix._load_config(kwargs)
             args = dict(cfp.items(cfg))
             args.update(kwargs)
             kwargs = args
+        replicas = kwargs.pop('replicas',None)
+        max_lag = float(kwargs.pop('replica_lag',30))
+        interval = float(kwargs.pop('replica_check',10))
 
         if _timeout is not None:
             self.timeout = _timeout
+        self._init_instrument(kwargs)
+        self._init_result_cache(kwargs)
+        self.chunk_size = int(kwargs.pop('chunk_size',self.chunk_size))
+        self.batch_size = int(kwargs.pop('batch_size',self.batch_size))
+        v = kwargs.pop('pool_size',None)
+        if v is not None:
+            self.max_size = int(v)
+        self.min_size = int(kwargs.pop('pool_min',self.min_size))
+        v = kwargs.pop('pool_timeout',None)
+        if v is not None:
+            self.acquire_timeout = float(v)
+        v = kwargs.pop('ping_idle',self.ping_idle)
+        self.ping_idle = float(v) if v is not None else None
+        self.check = bool(kwargs.pop('pool_check',self.check))
+        self.isolation = kwargs.pop('isolation',None)
 
         kwargs.setdefault('use_unicode',True)
         # kwargs.setdefault('no_delay',True)
 
         self.kwargs = kwargs
 
-        dbtype = kwargs.pop('dbtype','mysql')
+        dbtype = kwargs.pop('dbtype',dbtype)
         self.DB = _databases[dbtype](**kwargs)
         self.DB.dbtype=dbtype
+        self.DB.isolation=self.isolation
+        if getattr(self.DB,'max_conns',None):
+            self.max_size = min(self.max_size or self.DB.max_conns, self.DB.max_conns)
         if self._trace is not None:
             self._trace("INIT",dbtype,kwargs)
 
@@ -225,16 +784,137 @@ class Db(CtxObj, sqlmix.DbPrep):
         self.cleaner = None
         self.stopping = False
 
+        self.size = 0 # open connections, including those being opened
+        self._waiters = deque()
+        self.n_checkout = 0
+        self.checkout_time = 0.0
+        self.checkout_max = 0.0
+
+        self.replicas = None
+        if replicas:
+            common.pop('replicas',None)
+            if self.instrument is not None:
+                common['instrument'] = self.instrument
+            self.replicas = sqlmix._ReplicaSet([Db(_timeout=_timeout, **a) for a in
+                sqlmix._replica_args(replicas, common, cfp, dbtype)], max_lag, interval)
+
         super(Db,self).__init__()
 
     @asynccontextmanager
     async def _ctx(self):
-        async with anyio.create_task_group() as self._tg:
-            await self._tg.start(self._clean)
+        async with AsyncExitStack() as stack:
+            if self.replicas is not None:
+                for r in self.replicas.dbs:
+                    await stack.enter_async_context(r)
+            async with anyio.create_task_group() as self._tg:
+                await self._tg.start(self._clean)
+                if self.min_size:
+                    async with anyio.create_task_group() as tg:
+                        for _ in range(self.min_size - self.size):
+                            self.size += 1
+                            tg.start_soon(self._prewarm)
+                try:
+                    yield self
+                finally:
+                    self.close()
+
+    async def replication_lag(self):
+        """As sqlmix.Db.replication_lag"""
+        if self.DB.lag_sql is None:
+            return 0
+        try:
+            row = await self.DoFn(self.DB.lag_sql, _dict=True)
+        except NoData:
+            return 0
+        v = row.get(self.DB.lag_column)
+        return float(v) if v is not None else None
+
+    async def _replica(self, cmd, kv, conn=None):
+        """\
+        Reserve a replica for this statement; None: use the primary.
+        `conn` is the DbConn whose transaction may have written.
+        """
+        if self.replicas is None and self.result_cache is None:
+            return None
+        if not sqlmix._is_read(cmd):
+            if conn is not None:
+                conn._written(cmd)
+            return None
+        rs = self.replicas
+        if rs is None or kv.pop('_primary',False) or (conn is not None and conn.wrote):
+            return None
+        while True:
+            i,due = rs.pick()
+            if not due:
+                return i
             try:
-                yield self
-            finally:
-                self.close()
+                with anyio.fail_after(self.ping_timeout):
+                    lag = await rs.dbs[i].replication_lag()
+            except Exception:
+                lag = None
+            if rs.report(i, lag):
+                return i
+
+    async def _cache_get(self, cmd, kv, conn=None):
+        """As sqlmix.Db._cache_get; `conn` is the DbConn, if any"""
+        ttl = kv.get('_cache',None)
+        rc = self.result_cache
+        if not ttl or rc is None or (conn is not None and conn.wrote):
+            return None
+        pcmd = self.prep(cmd, **kv)
+        key,e = rc.lookup(pcmd)
+        if e is None:
+            tables = sqlmix._tables(pcmd[0])
+            gen = rc.generation(tables)
+            rows = []
+            async for r in (conn or self).DoSelect(cmd, **sqlmix._fill_args(kv)):
+                rows.append(r)
+            e = rc.store(key, tables, gen, rows[0], rows[1:], float(ttl))
+        return pcmd,e
+
+    async def _on_replica(self, i, name, cmd, kv, fallback):
+        rs = self.replicas
+        try:
+            res = await getattr(rs.dbs[i],name)(cmd, **kv)
+        except Exception as e:
+            if sqlmix.error_kind(e) != "conn_lost":
+                rs.done(i)
+                raise
+            rs.report(i, None)
+            kv['_primary'] = True
+            return await getattr(fallback,name)(cmd, **kv)
+        rs.done(i)
+        return res
+
+    async def _replica_rows(self, i, cmd, kv, fallback):
+        """\
+        Pass on the rows of a replica's DoSelect, then release the replica.
+        If its connection is lost before the first row, read from `fallback`.
+        """
+        rs = self.replicas
+        lost = False
+        n = 0
+        try:
+            async for r in rs.dbs[i].DoSelect(cmd,**kv):
+                n += 1
+                yield r
+        except Exception as e:
+            if n or sqlmix.error_kind(e) != "conn_lost":
+                raise
+            lost = True
+        finally:
+            if lost:
+                rs.report(i, None)
+            else:
+                rs.done(i)
+        if lost:
+            kv['_primary'] = True
+            async for r in fallback.DoSelect(cmd,**kv):
+                yield r
+
+    def replica_stats(self):
+        """As sqlmix.Db.replica_stats"""
+        return self.replicas.stats() if self.replicas is not None else []
 
 
     def stop(self):
@@ -248,11 +928,12 @@ class Db(CtxObj, sqlmix.DbPrep):
         finally:
             self._put_db(res)
 
-    async def _get_db(self):
-        if self.db:
-            r = self.db.pop()[0]
-            s="OLD"
-        else:
+    async def _prewarm(self):
+        self._put_db(await self._open())
+
+    async def _open(self):
+        """Open a new connection. Its slot has already been counted."""
+        try:
             evt = self.DB.conn(self)
             try:
                 await evt.wait()
@@ -261,34 +942,152 @@ class Db(CtxObj, sqlmix.DbPrep):
                     evt.scope.cancel()
                 # otherwise let's hope that the job won't run
                 raise
-            else:
-                r = evt.db
-            s="NEW"
+        except BaseException:
+            self._free_slot()
+            raise
+        return evt.db
 
+    async def _get_db(self):
+        t = time()
+        if self.db and not self._waiters:
+            r = self.db.pop()[0]
+            if self.check or (self.ping_idle is not None and t-r._sqlmix_used >= self.ping_idle):
+                if not await self._ping(r):
+                    return await self._get_db()
+            s="OLD"
+        elif (self.max_size is None or self.size < self.max_size) and not self._waiters:
+            self.size += 1
+            r = await self._open()
+            s="NEW"
+        else:
+            w = _Waiter()
+            self._waiters.append(w)
+            try:
+                with anyio.fail_after(self.acquire_timeout):
+                    await w.evt.wait()
+            except BaseException as exc:
+                if w.conn is not None:
+                    self._put_db(w.conn)
+                elif w.slot:
+                    self._free_slot()
+                else:
+                    self._waiters.remove(w)
+                if isinstance(exc,TimeoutError):
+                    raise sqlmix.PoolTimeout(self.acquire_timeout) from None
+                raise
+            if w.slot:
+                r = await self._open()
+                s="NEW"
+            else:
+                r = w.conn
+                s="WAIT"
+
+        t = time()-t
+        self.n_checkout += 1
+        self.checkout_time += t
+        if self.checkout_max < t:
+            self.checkout_max = t
         debug(s)
         return r
 
     def _put_db(self,db):
+        if getattr(db,"_sqlmix_dead",False):
+            return
         if self.db is None or self.stopping:
-            db._sqlmix_scope.cancel()
+            self._discard(db)
+            return
+        while self._waiters:
+            w = self._waiters.popleft()
+            if w.evt.is_set():
+                continue
+            w.conn = db
+            w.evt.set()
             return
-        t = time()+self.timeout
-        self.db.append((db,t))
+        db._sqlmix_used = t = time()
+        self.db.append((db,t+self.timeout))
         debug("BACK",getattr(db,"tid",None))
+
+    async def _ping(self, db):
+        """Check an idle connection; discard it if it's dead"""
+        try:
+            with anyio.fail_after(self.ping_timeout):
+                await self.DB.ping(db)
+        except Exception:
+            debug("DEAD")
+            self._discard(db)
+            if self.size < self.min_size and not self.stopping:
+                self.size += 1
+                self._tg.start_soon(self._prewarm)
+            return False
+        db._sqlmix_used = time()
+        return True
+
+    async def _keepalive(self, entry):
+        """Ping an idle connection; replace it if it's dead"""
+        if entry not in self.db:
+            return
+        self.db.remove(entry)
+        db = entry[0]
+        if not await self._ping(db):
+            pass
+        elif self._waiters or self.stopping:
+            self._put_db(db)
+        else:
+            self.db.append(entry)
+            self.db.sort(key=lambda x: x[1])
+
+    def _discard(self,db):
+        """Close a connection and let the next waiter open a new one"""
+        if getattr(db,"_sqlmix_dead",False):
+            return
+        db._sqlmix_dead = True
+        sc = getattr(db,"_sqlmix_scope",None)
+        if sc is not None:
+            db._sqlmix_scope = None
+            sc.cancel()
+        else:
+            db.close()
+        self._free_slot()
+
+    def _free_slot(self):
+        while self._waiters:
+            w = self._waiters.popleft()
+            if w.evt.is_set():
+                continue
+            w.slot = True
+            w.evt.set()
+            return
+        self.size -= 1
+
+    def stats(self):
+        """Pool statistics"""
+        busy = self.size-len(self.db)
+        return dict(size=self.size, idle=len(self.db), busy=busy,
+            waiters=len(self._waiters), max_size=self.max_size, min_size=self.min_size,
+            utilisation=busy/self.max_size if self.max_size else None,
+            checkouts=self.n_checkout, checkout_max=self.checkout_max,
+            checkout_avg=self.checkout_time/self.n_checkout if self.n_checkout else 0.0)
     
     async def _clean(self, task_status):
         with anyio.CancelScope() as self.cleaner:
             task_status.started()
             while True:
-                if not self.db:
-                    await anyio.sleep(self.timeout)
-                    continue
                 t = time()
-                if self.db[0][1] <= t:
+                if len(self.db) > self.min_size and self.db[0][1] <= t:
                     db = self.db.pop(0)[0]
-                    db.close()
+                    self._discard(db)
                     continue
-                await anyio.sleep(self.db[0][1]-t)
+                wake = t+min(self.timeout,self.ping_idle or self.timeout)
+                if len(self.db) > self.min_size:
+                    wake = self.db[0][1]
+                if self.ping_idle is not None:
+                    for entry in self.db[:]:
+                        due = entry[0]._sqlmix_used+self.ping_idle
+                        if due <= t:
+                            await self._keepalive(entry)
+                            due = time()+self.ping_idle
+                        wake = min(wake,due)
+                await anyio.sleep(max(wake-time(),0))
 
     def close(self):
         self.stopping = True
@@ -322,8 +1121,9 @@ class Db(CtxObj, sqlmix.DbPrep):
         >>>     return d
         >>> d = await dbpool(proc, 10)
 
-        The procedure will be retried up to 10 times if there are errors;
-        if they persist, the first error will be re-raised.
+        The procedure will be retried up to 10 times if it fails because
+        of a deadlock or a similar transient error; `retry` may also be a
+        sqlmix.Retry policy.
 
         """
         if job is None:
@@ -333,48 +1133,35 @@ class Db(CtxObj, sqlmix.DbPrep):
         return self._call(job,retry)
 
     async def _call(self, job, retry):
-        global tid
-        tid += 1
-        mtid = tid
-        err = None
-        debug("STARTCALL",job,retry,mtid)
+        policy = sqlmix.Retry.get(retry)
+        debug("STARTCALL",job,retry)
 
-        e1 = None
+        n = 0
         try:
             while True:
-                db = self._get_db()
-                self._note(db)
                 try:
-                    debug("CALL JOB",mtid)
-                    d = await job(db)
-                    debug("RET JOB",mtid,d)
-                    def pr(r):
-                        debug("RES JOB",mtid,r)
-                        return r
-                    return d
-                except (EnvironmentError,NameError) as e:
-                    self._denote(db)
-                    await db.rollback()
-                    raise
+                    async with self() as db:
+                        debug("CALL JOB",n)
+                        if policy.timeout is None:
+                            res = await job(db)
+                        else:
+                            with anyio.move_on_after(policy.timeout) as sc:
+                                res = await job(db)
+                            if sc.cancelled_caught:
+                                raise sqlmix.AttemptTimeout(policy.timeout)
+                        debug("RES JOB",n,res)
                 except Exception as e:
-                    self._denote(db)
-                    await db.rollback()
-                    if e1 is None:
-                        e1 = e
-                    if retry:
-                        retry -= 1
-                        continue
-                    raise e1
-                except BaseException:
-                    self._denote(db)
-                    await db.rollback()
-                    raise
+                    delay = policy.check(e,n)
+                    if delay is None:
+                        raise
+                    debug("RETRY JOB",n,e,delay)
+                    n += 1
+                    await anyio.sleep(delay)
                 else:
-                    self._denote(db)
-                    await db.commit()
+                    policy.check(None,n)
                     return res
         finally:
-            debug("ENDCALL",job,retry)
+            debug("ENDCALL",job,n)
 
     def _note(self,x):
         if not _DEBUG: return
@@ -389,11 +1176,37 @@ class Db(CtxObj, sqlmix.DbPrep):
             return await db.Do(cmd, **kv)
 
     async def DoFn(self,cmd,**kv):
+        c = await self._cache_get(cmd, kv)
+        if c is not None:
+            return sqlmix._cached_one(c[1], c[0], kv)
+        i = await self._replica(cmd, kv)
+        if i is not None:
+            return await self._on_replica(i, "DoFn", cmd, kv, self)
         async with self() as db:
             return await db.DoFn(cmd, **kv)
 
+    async def DoMany(self,cmd,rows,**kv):
+        async with self() as db:
+            return await db.DoMany(cmd, rows, **kv)
+
+    async def DoColumns(self,cmd,**kv):
+        i = await self._replica(cmd, kv)
+        if i is not None:
+            return await self._on_replica(i, "DoColumns", cmd, kv, self)
+        async with self() as db:
+            return await db.DoColumns(cmd, **kv)
+
     async def DoSelect(self,cmd,**kv):
-        n = 0
+        c = await self._cache_get(cmd, kv)
+        if c is not None:
+            for r in sqlmix._cached_rows(c[1], c[0], kv):
+                yield r
+            return
+        i = await self._replica(cmd, kv)
+        if i is not None:
+            async for r in self._replica_rows(i, cmd, kv, self):
+                yield r
+            return
         async with self() as db:
             async for r in db.DoSelect(cmd,**kv):
                 yield r
@@ -410,6 +1223,8 @@ class DbConn(CtxObj):
     curs = None
     db = None
     work = 0
+    wrote = False
+    dirty = None
 
     def __init__(self,pool):
         self.pool = pool
@@ -435,7 +1250,13 @@ class DbConn(CtxObj):
                 except Exception as exc:
                     from traceback import format_exception
                     debug("ERROR",format_exception(exc))
-                    await self.rollback()
+                    if sqlmix.error_kind(exc) in ("conn_lost","timeout"):
+                        # the connection is in an unknown state
+                        self.pool._discard(self.db)
+                        self.work = 0
+                        await self._run_rolledback()
+                    else:
+                        await self.rollback()
                     raise
                 try:
                     await self.commit()
@@ -448,7 +1269,7 @@ class DbConn(CtxObj):
             self.pool._put_db(self.db)
             raise
         except BaseException:
-            self.db._sqlmix_scope.cancel()
+            self.pool._discard(self.db)
             raise
         else:
             self.pool._put_db(self.db)
@@ -456,6 +1277,27 @@ class DbConn(CtxObj):
             self.db = None
 
 
+    def _written(self, cmd):
+        """As sqlmix.Db._written"""
+        self.wrote = True
+        rc = self.pool.result_cache
+        if rc is None:
+            return
+        if self.dirty is None:
+            self.dirty = set()
+            self.call_committed(self._flush_dirty, rc)
+            self.call_rolledback(self._flush_dirty, None)
+        tables = sqlmix._tables(cmd)
+        if tables:
+            self.dirty.update(tables)
+        else:
+            self.dirty.add(None)
+
+    def _flush_dirty(self, rc):
+        d,self.dirty = self.dirty,None
+        if rc is not None and d:
+            rc.invalidate(() if None in d else d)
+
     def call_committed(self,proc,*a,**k):
         self.committed.append((proc,a,k))
     def call_rolledback(self,proc,*a,**k):
@@ -480,10 +1322,7 @@ class DbConn(CtxObj):
         if self.curs is not None:
             self.curs.close()
             self.curs = None
-        sc = self.db._sqlmix_scope
-        if sc is not None:
-            self.db._sqlmix_scope = None
-            sc.cancel()
+        self.pool._discard(self.db)
 
     async def commit(self,res=None):
         if self.work == 0:
@@ -491,6 +1330,7 @@ class DbConn(CtxObj):
         debug("COMMIT",self.id)
         await self.db.commit()
         self.work = 0
+        self.wrote = False
         await self._run_committed()
 
     async def rollback(self,res=None):
@@ -499,22 +1339,83 @@ class DbConn(CtxObj):
         debug("ROLLBACK",self.id)
         await self.db.rollback()
         self.work = 0
+        self.wrote = False
         await self._run_rolledback()
 
-    async def _cursor(self, cmd, **kv):
-        cmd = self.pool.prep(cmd, **kv)
+    async def _explain(self, p):
+        """Log a slow statement, with its plan"""
+        sql = self.DB.explain_sql(p.cmd[0])
+        plan = None
+        sp = self.DB.explain_savepoint
+        if sql is not None:
+            try:
+                async with self.db.cursor() as curs:
+                    if sp:
+                        await curs.execute("SAVEPOINT sqlmix_explain")
+                    try:
+                        await curs.execute(sql, *p.cmd[1:])
+                        plan = [list(r) for r in await curs.fetchall()]
+                    except Exception:
+                        if sp:
+                            await curs.execute("ROLLBACK TO SAVEPOINT sqlmix_explain")
+                        raise
+                    if sp:
+                        await curs.execute("RELEASE SAVEPOINT sqlmix_explain")
+            except Exception as e:
+                plan = "%s: %s" % (type(e).__name__, e)
+        p.slow_log.write(p, p.slow, plan)
+
+    async def _cursor(self, cmd, kv, probe=None):
+        src,cmd = cmd,self.pool.prep(cmd, **kv)
+        if probe is not None:
+            probe.prepped(cmd, src)
         try:
             async with self.db.cursor() as curs:
                 await curs.execute(*cmd)
-        except:
+        except Exception as e:
+            fixup_error(cmd)
+            if probe is not None:
+                probe.done(e)
+            raise
+        if probe is not None:
+            probe.executed()
+        return curs
+
+    async def _select(self, cmd, kv, probe=None):
+        """Run a query; use a server-side cursor if the result is to be streamed"""
+        if kv.get('_store',self.DB._store) or not self.DB.declare_cursor:
+            return await self._cursor(cmd, kv, probe)
+        src,cmd = cmd,self.pool.prep(cmd, **kv)
+        if probe is not None:
+            probe.prepped(cmd, src)
+        batch = kv.get('_batch',self.pool.batch_size)
+        if hasattr(self.db,'stream_cursor'):
+            curs = self.db.stream_cursor(batch)
+        else:
+            curs = _DeclaredCursor(await self.db.cursor(), batch)
+        try:
+            await curs.execute(*cmd)
+        except Exception as e:
             fixup_error(cmd)
+            curs.close()
+            if probe is not None:
+                probe.done(e)
             raise
+        if probe is not None:
+            probe.executed()
         return curs
-        
+
     async def DoFn(self, cmd, **kv):
         debug("DOFN",self.id,cmd,kv)
+        c = await self.pool._cache_get(cmd, kv, self)
+        if c is not None:
+            return sqlmix._cached_one(c[1], c[0], kv)
+        i = await self.pool._replica(cmd, kv, self)
+        if i is not None:
+            return await self.pool._on_replica(i, "DoFn", cmd, kv, self)
         self.work += 1
-        curs = await self._cursor(cmd, **kv)
+        p = self.pool._probe("DoFn")
+        curs = await self._cursor(cmd, kv, p)
 
         if hasattr(curs,'fetchone'):
             val = await curs.fetchone()
@@ -522,36 +1423,43 @@ class DbConn(CtxObj):
             val = None
         else:
             val = curs.rows.pop(0)
+        if p is not None:
+            p.fetched((val,) if val else ())
+            p.done()
+            if p.slow is not None:
+                await self._explain(p)
 
         if self._trace is not None:
             self._trace("DoFn",cmd,val)
         if not val:
             raise NoData(cmd,kv)
 
-        as_dict=kv.get("_dict",None)
-        if as_dict:
-            if as_dict is True:
-                as_dict = dict
-            names = map(lambda x:x[0], curs.description)
+        make_row = sqlmix._row_factory(curs, kv)
 
         if ((await curs.fetchone()) is not None) if hasattr(curs,'fetchone') else curs.rows:
             raise ManyData(cmd)
         if self.curs is None:
             await curs.aclose()
 
-        if as_dict:
-            val = as_dict(zip(names,val))
+        if make_row is not None:
+            val = make_row(val)
         return val
 
     async def Do(self, cmd, **kv):
         """Database-specific Do function"""
         debug("DO",self.id,cmd,kv)
         self.work += 1
-        curs = await self._cursor(cmd, **kv)
+        self._written(cmd)
+        p = self.pool._probe("Do")
+        curs = await self._cursor(cmd, kv, p)
 
         r = curs.lastrowid
         if not r:
             r = curs.rowcount
+        if p is not None:
+            p.done(rows=max(curs.rowcount,0))
+            if p.slow is not None:
+                await self._explain(p)
         if self.curs is None:
             await curs.aclose()
 
@@ -561,46 +1469,137 @@ class DbConn(CtxObj):
             raise NoData(cmd, kv)
         return r
 
+    async def DoMany(self, cmd, rows, **kv):
+        """Database-specific DoMany function"""
+        debug("DOMANY",self.id,cmd)
+        self.work += 1
+        self._written(cmd)
+        p = self.pool._probe("DoMany")
+        tmpl = self.pool.compile(cmd)
+        chunk = kv.pop('_chunk',self.pool.chunk_size)
+        empty = kv.pop('_empty',False)
+        values = None
+        if kv.pop('_values',True):
+            values = self.pool.compile_values(cmd)
+
+        if p is not None:
+            p.prepped(tmpl.sql, cmd)
+        n = 0
+        async with self.db.cursor() as curs:
+            try:
+                # building the chunks may fail too, e.g. on a short row
+                for args in sqlmix._chunks(tmpl.rows(rows,kv), chunk):
+                    if p is not None:
+                        p.start()
+                    if values is not None:
+                        for stmt in self.pool.values_stmts(values,args):
+                            await curs.execute(*stmt)
+                            if curs.rowcount > 0:
+                                n += curs.rowcount
+                    else:
+                        await curs.executemany(tmpl.sql,args)
+                        if curs.rowcount > 0:
+                            n += curs.rowcount
+                    if p is not None:
+                        p.executed()
+            except Exception as e:
+                fixup_error(tmpl.sql)
+                if p is not None:
+                    p.done(e, n)
+                raise
+        if p is not None:
+            p.done(rows=n)
+
+        if self._trace is not None:
+            self._trace("DoMany",tmpl.sql,n)
+        if n == 0 and not empty:
+            raise NoData(cmd, kv)
+        return n
+
+    async def DoColumns(self, cmd, **kv):
+        """Database-specific DoColumns function"""
+        debug("DOCOL",self.id,cmd,kv)
+        i = await self.pool._replica(cmd, kv, self)
+        if i is not None:
+            return await self.pool._on_replica(i, "DoColumns", cmd, kv, self)
+        self.work += 1
+        p = self.pool._probe("DoColumns")
+        curs = await self._select(cmd, kv, p)
+
+        res = sqlmix._Columns([x[0] for x in curs.description])
+        try:
+            async for rows in _fetch_batches(curs, kv.get('_batch',self.pool.batch_size), p):
+                res.add(rows)
+        except Exception as e:
+            if p is not None:
+                p.error = type(e).__name__
+            raise
+        finally:
+            if p is not None:
+                p.done()
+            if self.curs is None:
+                with anyio.move_on_after(3, shield=True):
+                    await curs.aclose()
+        if p is not None and p.slow is not None:
+            await self._explain(p)
+
+        if self._trace is not None:
+            self._trace("DoColumns",cmd,res.n)
+        if not res.n and not kv.get('_empty', False):
+            raise NoData(cmd, kv)
+        return res.result(kv.get('_numpy',True))
+
     async def DoSelect(self, cmd, **kv):
         """Database-specific DoSelect function"""
         debug("DOSEL",self.id,cmd,kv)
+        c = await self.pool._cache_get(cmd, kv, self)
+        if c is not None:
+            for r in sqlmix._cached_rows(c[1], c[0], kv):
+                yield r
+            return
+        i = await self.pool._replica(cmd, kv, self)
+        if i is not None:
+            async for r in self.pool._replica_rows(i, cmd, kv, self):
+                yield r
+            return
         self.work += 1
-        curs = await self._cursor(cmd, **kv)
+        p = self.pool._probe("DoSelect")
+        curs = await self._select(cmd, kv, p)
 
         n = 0
-        as_dict=kv.get("_dict",None)
-        if as_dict is True:
-            as_dict = dict
-        if as_dict:
-            names = list(map(lambda x:x[0], curs.description))
+        make_row = sqlmix._row_factory(curs, kv)
+        head = kv.get('_head',None)
 
         try:
-            while True:
-                if hasattr(curs,'fetchone'):
-                    val = await curs.fetchone()
-                    if val is None:
-                        break
-                elif not curs.rows:
-                    break
-                else:
-                    val = curs.rows.pop(0)
-
-                if as_dict:
-                    val = as_dict(zip(names,val))
+            if head:
+                yield curs.description if head > 1 else [x[0] for x in curs.description]
+            async for val in _fetch_rows(curs, kv.get('_batch',self.pool.batch_size), p):
+                if make_row is not None:
+                    val = make_row(val)
 
                 n += 1
                 yield val
 
+        except Exception as e:
+            if p is not None:
+                p.error = type(e).__name__
+            raise
         finally:
+            if p is not None:
+                p.done()
             if self._trace is not None:
-                self._trace("DoSel",_cmd,val)
+                self._trace("DoSelect",cmd,n)
             if self.curs is None:
                 with anyio.move_on_after(3, shield=True):
                     await curs.aclose()
+        if p is not None and p.slow is not None:
+            await self._explain(p)
         if n == 0 and not kv.get('_empty', False):
             raise NoData(cmd, kv)
 
     Do.__doc__ = sqlmix.Db.Do.__doc__ + "\nReturns a Future.\n"
     DoFn.__doc__ = sqlmix.Db.DoFn.__doc__ + "\nReturns a Future.\n"
+    DoMany.__doc__ = sqlmix.Db.DoMany.__doc__ + "\nReturns a Future.\n"
+    DoColumns.__doc__ = sqlmix.Db.DoColumns.__doc__ + "\nReturns a Future.\n"
     DoSelect.__doc__ = sqlmix.Db.DoSelect.__doc__ + "\nReturns a Future.\n"
 
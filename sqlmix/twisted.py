@@ -45,15 +45,19 @@ from traceback import print_exc
 from zope.interface import implements
 from twisted.application import service
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred,DeferredList,maybeDeferred,inlineCallbacks,returnValue,succeed
+from twisted.internet.defer import Deferred,DeferredList,maybeDeferred,inlineCallbacks,returnValue,succeed,fail,CancelledError
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.task import deferLater
 from twisted.python import log
 from twisted.python.failure import Failure
 from twisted.python.threadpool import ThreadPool
 from twisted.internet import threads
-from threading import Lock
-from Queue import Queue
+from threading import Lock,Event
+from Queue import Queue,Empty
+from collections import deque
+from itertools import islice
 
-__all__ = ('DbPool','NoData','ManyData')
+__all__ = ('DbPool','NoData','ManyData','RowStream')
 
 _DEBUG = False
 
@@ -64,6 +68,18 @@ def _call(r,p,a,k):
 	"""Drop the first argument (i.e. lose the Deferred result)"""
 	return p(*a,**k)
 
+def _timeout(d,t):
+	"""Fail a Deferred with AttemptTimeout if it doesn't fire in time"""
+	c = reactor.callLater(t,d.cancel)
+	def done(r):
+		if c.active():
+			c.cancel()
+		elif isinstance(r,Failure) and r.check(CancelledError):
+			r = Failure(sqlmix.AttemptTimeout(t))
+		return r
+	d.addBoth(done)
+	return d
+
 def tname():
 	import threading
 	try:
@@ -99,10 +115,21 @@ class DbPool(object,service.Service):
 	"""\
 	Manage a pool of database connections.
 
-	TODO: shrink the pool.
-	TODO: issue periodic keepalive requests.
+	pool_size (default 100) limits the number of connections, and thus
+	of worker threads. Requests for a connection beyond that wait in line
+	(pool_timeout: fail with sqlmix.PoolTimeout after that many seconds).
+	A connection only occupies a thread while it is in use. Idle ones
+	are closed after pool_idle seconds, except for pool_min of them.
+
+	Idle connections are pinged every `ping_idle` seconds (an argument of
+	sqlmix.Db, which also checks connections when a transaction starts
+	after that much idle time). With pool_check=True, connections are
+	also pinged whenever they're taken from the pool.
 	"""
 	timeout = 70 # one minute plus
+	max_size = 100
+	min_size = 0
+	acquire_timeout = None
 	implements(service.IService)
 
 	def __init__(self,*a,**k):
@@ -111,15 +138,43 @@ class DbPool(object,service.Service):
 		SQL commands in the background.
 		"""
 		k['_single_thread'] = True
-
-		self.db = []
+		if k.get('instrument') is True:
+			# one collector for all worker threads
+			k['instrument'] = sqlmix.StmtStats()
+		self.instrument = k.get('instrument')
+		rc = k.get('result_cache',None)
+		if rc is not None and not isinstance(rc,sqlmix.ResultCache):
+			# one cache for all worker threads, so that they see each other's writes
+			rc = sqlmix.ResultCache() if rc is True else sqlmix.ResultCache(int(rc)) if int(rc) else None
+			k['result_cache'] = rc
+		self.result_cache = rc
+
+		# these apply to the pool, not to each worker's sqlmix.Db
+		self.max_size = int(k.pop('pool_size',self.max_size))
+		self.min_size = int(k.pop('pool_min',self.min_size))
+		v = k.pop('pool_timeout',None)
+		if v is not None:
+			self.acquire_timeout = float(v)
+		self.timeout = float(k.pop('pool_idle',self.timeout))
+
+		self.db = [] # idle connections: (sqlmix.Db, expiry)
+		self.size = 0 # open connections
+		self.running = 0 # worker threads in use
+		self._waiters = deque() # handles waiting for a connection
+		self.n_checkout = 0
+		self.wait_time = 0.0
+		self.wait_max = 0.0
 		self.args = a
 		self.kwargs = k
 		self.lock = Lock()
 		self.cleaner = None
 		self._tb = {}
 		self.stopping = False
-		self.threads = ThreadPool(minthreads=2, maxthreads=100, name="Database")
+		self.ping_idle = k.get('ping_idle',sqlmix.Db.ping_idle)
+		if self.ping_idle is not None:
+			self.ping_idle = float(self.ping_idle)
+		self.check = k.get('pool_check',False)
+		self.threads = ThreadPool(minthreads=min(2,self.max_size), maxthreads=self.max_size, name="Database")
 		self.threads.start()
 		#reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
 		reactor.addSystemEventTrigger('after', 'shutdown', self._dump)
@@ -128,19 +183,33 @@ class DbPool(object,service.Service):
 	def stop2(self):
 		if self.db is not None:
 			for db in self.db:
-				db[0].close("AfterShutdown Service")
+				db[0].close()
+		for w in self._waiters:
+			w._abort(RuntimeError("AfterShutdown Service"))
+		self._waiters.clear()
 		self.threads.stop()
 
 	def stop(self):
 		self.stopping = True
 
 	def _get_db(self,tid=None):
+		r = _DbThread(self)
 		if self.db:
-			r = self.db.pop()[0]
+			conn = self.db.pop()[0]
 			s="OLD"
-		else:
-			r = _DbThread(self)
+			if self.check:
+				self._ping(r)
+			self._start(r,conn)
+		elif self.size < self.max_size:
 			s="NEW"
+			self.size += 1
+			self._start(r,None)
+		else:
+			s="WAIT"
+			r.waiting = time()
+			self._waiters.append(r)
+			if self.acquire_timeout is not None:
+				r.timer = reactor.callLater(self.acquire_timeout,self._wait_timeout,r)
 
 		if tid:
 			debug(s, r.tid,tid)
@@ -150,41 +219,145 @@ class DbPool(object,service.Service):
 
 		return r
 
+	def _start(self,r,conn):
+		"""Give a handle a worker thread, with this connection (None: open one)"""
+		self.running += 1
+		self.n_checkout += 1
+		if r.waiting is not None:
+			t = time()-r.waiting
+			self.wait_time += t
+			self.wait_max = max(self.wait_max,t)
+			r.waiting = None
+			if r.timer is not None:
+				r.timer.cancel()
+				r.timer = None
+		r.done = threads.deferToThreadPool(reactor, self.threads, r.run,r.q,conn)
+		r.done.addCallback(self._parked)
+		r.done.addErrback(self._lost)
+
+	def _wait_timeout(self,r):
+		r.timer = None
+		try:
+			self._waiters.remove(r)
+		except ValueError:
+			return
+		r._abort(sqlmix.PoolTimeout(self.acquire_timeout))
+
 	def _put_db(self,db):
+		"""A handle is done: release its thread, keep its connection"""
+		if db.q is None:
+			raise RuntimeError("Queueing closed DB handle")
 		if self.db is None or self.stopping:
 			db.close("Shutdown")
 			return db.done
-		if db.q is None:
-			raise RuntimeError("Queueing closed DB handle")
-		for d in self.db:
-			if db is d[0]:
-				raise RuntimeError("DoubleQueued")
-		db.count = 0
-		try:
-			t = time()+self.timeout
-			self.db.append((db,t))
-			if self.cleaner is None:
-				self.cleaner = reactor.callLater(self.timeout,self._clean)
-		except Exception:
-			print_exc()
+		if db.waiting is not None:
+			# never got a connection
+			try:
+				self._waiters.remove(db)
+			except ValueError:
+				pass
+			db._abort(RuntimeError("Released"))
+			return
+		db.q.put((None,"PARK",[],{}))
+		db.q = None
+		debug("BACK",db.tid)
+		return db.done
+
+	def _parked(self,conn):
+		"""A worker thread has ended; `conn` is its connection, unless closed"""
+		self.running -= 1
+		if conn is None:
+			self._lost(None)
+			return
+		if self._waiters:
+			self._start(self._waiters.popleft(),conn)
+			return
+		if self.db is None or self.stopping:
+			self._close_conn(conn)
+			return
+		conn.used = time()
+		self.db.append((conn,time()+self.timeout))
+		if self.cleaner is None:
+			self.cleaner = reactor.callLater(self.timeout,self._clean)
+
+	def _lost(self,f):
+		"""A connection is gone; let the next waiter open a new one"""
+		if f is not None:
+			self.running -= 1
+			log.err(f)
+		if self._waiters and not self.stopping:
+			self._start(self._waiters.popleft(),None)
 		else:
-			debug("BACK",db.tid)
-	
+			self.size -= 1
+
+	def _close_conn(self,conn):
+		d = threads.deferToThreadPool(reactor, self.threads, conn.close)
+		d.addErrback(log.err)
+		d.addBoth(lambda _: self._lost(None))
+		return d
+
 	def _clean(self):
 		self.cleaner = None
 		t = time()
-		while self.db and self.db[0][1] <= t:
-			db = self.db.pop(0)[0]
-			db.close("Timeout")
+		while len(self.db) > self.min_size and self.db[0][1] <= t:
+			conn = self.db.pop(0)[0]
+			self._close_conn(conn)
 		if self.db:
-			self.cleaner = reactor.callLater(self.db[0][1]-t,self._clean)
+			wake = max(self.db[0][1]-t,1) if len(self.db) > self.min_size else self.timeout
+			if self.ping_idle is not None:
+				for entry in self.db[:]:
+					if entry[0].used+self.ping_idle <= t:
+						self._ping_idle(entry)
+				wake = min(wake,self.ping_idle)
+			self.cleaner = reactor.callLater(wake,self._clean)
+
+	def _ping(self,db):
+		"""\
+			Queue a keepalive check. The worker's sqlmix.Db replaces
+			the connection if it is dead.
+			"""
+		d = Deferred()
+		debug("PING",db.tid)
+		db.q.put((d,"ping",[],{}))
+		d.addErrback(log.err)
+
+	def _ping_idle(self,entry):
+		"""Check an idle connection in a pool thread"""
+		self.db.remove(entry)
+		conn = entry[0]
+		conn.used = time()
+		self.running += 1
+		d = threads.deferToThreadPool(reactor, self.threads, conn.ping)
+		def done(_):
+			self.running -= 1
+			if self._waiters:
+				self._start(self._waiters.popleft(),conn)
+			elif self.db is None or self.stopping:
+				self._close_conn(conn)
+			else:
+				self.db.append(entry)
+				self.db.sort(key=lambda x: x[1])
+		def failed(f):
+			self.running -= 1
+			log.err(f)
+			self._close_conn(conn)
+		d.addCallbacks(done,failed)
+
+	def stats(self):
+		"""Pool statistics: connections, worker threads, waiting requests"""
+		return dict(size=self.size, idle=len(self.db or ()), busy=self.running,
+			waiters=len(self._waiters), max_size=self.max_size, min_size=self.min_size,
+			utilisation=float(self.running)/self.max_size if self.max_size else None,
+			checkouts=self.n_checkout, wait_max=self.wait_max,
+			wait_avg=self.wait_time/self.n_checkout if self.n_checkout else 0.0)
+
 	def __del__(self):
 		if self.cleaner:
-			reactor.cancelCallLater(self.cleaner)
+			self.cleaner.cancel()
 			self.cleaner = None
 		while self.db:
-			db = self.db.pop(0)[0]
-			db.close("Nonref Parent")
+			conn = self.db.pop(0)[0]
+			conn.close()
 
 	def stopService(self):
 		super(DbPool,self).stopService()
@@ -194,10 +367,10 @@ class DbPool(object,service.Service):
 		dbl = self.db
 		self.db = None
 		dl = []
-		for db in dbl:
-			db = db[0]
-			db.close("Shutdown Service")
-			dl.append(db.done)
+		for conn,_ in dbl:
+			dl.append(self._close_conn(conn))
+		while self._waiters:
+			self._waiters.popleft()._abort(RuntimeError("Shutdown Service"))
 		return DeferredList(dl)
 		
 	def __call__(self, job=None,retry=0):
@@ -228,8 +401,9 @@ class DbPool(object,service.Service):
 		>>>     return d
 		>>> d = dbpool(proc, 10)
 
-		The procedure will be retried up to 10 times if there are errors;
-		if they persist, the first error will be re-raised.
+		The procedure will be retried up to 10 times if it fails because
+		of a deadlock or a similar transient error; `retry` may also be a
+		sqlmix.Retry policy.
 
 		"""
 		if not job:
@@ -241,33 +415,28 @@ class DbPool(object,service.Service):
 		global tid
 		tid += 1
 		mtid = tid
+		policy = sqlmix.Retry.get(retry)
 		debug("STARTCALL",job,retry,mtid)
 
-		e1 = None
+		n = 0
 		try:
 			while True:
 				db = self._get_db(mtid)
 				self._note(db)
+				err = None
 				try:
 					debug("CALL JOB",mtid)
-					d = job(db)
-					debug("RET JOB",mtid,d)
-					def pr(r):
-						debug("RES JOB",mtid,r)
-						return r
-					d.addBoth(pr)
+					d = maybeDeferred(job,db)
+					if policy.timeout is not None:
+						_timeout(d,policy.timeout)
 					res = yield d
-				except (EnvironmentError,NameError):
-					self._denote(db)
-					yield db.rollback()
-					raise
+					debug("RES JOB",mtid,res)
 				except Exception:
+					err = Failure()
 					self._denote(db)
-					yield db.rollback()
-					if retry:
-						retry -= 1
-						continue
-					raise
+					d = db.rollback()
+					d.addErrback(log.err)
+					yield d
 				except BaseException:
 					self._denote(db)
 					yield db.rollback()
@@ -276,20 +445,28 @@ class DbPool(object,service.Service):
 					self._denote(db)
 					if isinstance(res,BaseException):
 						yield db.rollback()
-						if isinstance(res,(EnvironmentError,NameError)):
-							returnValue( res )
-						elif isinstance(res,Exception):
-							if retry:
-								retry -= 1
-								continue
+						if not isinstance(res,Exception):
 							returnValue( res )
-						else: # BaseException
+						delay = policy.check(res,n)
+						if delay is None:
 							returnValue( res )
 					else:
-						yield db.commit()
-					returnValue( res )
+						try:
+							yield db.commit()
+						except Exception:
+							err = Failure()
+						else:
+							policy.check(None,n)
+							returnValue( res )
+				if err is not None:
+					delay = policy.check(err.value,n)
+					if delay is None:
+						err.raiseException()
+				debug("RETRY JOB",mtid,n,delay)
+				n += 1
+				yield deferLater(reactor,delay,lambda: None)
 		finally:
-			debug("ENDCALL",job,retry)
+			debug("ENDCALL",job,n)
 
 	def _note(self,x):
 		if not _DEBUG: return
@@ -314,6 +491,138 @@ def _do_callback(tid,d,res):
 	d.callback(res)
 	debug("DID_CB",tid,d,res)
 
+def _do_callbacks(tid,results):
+	for d,res in results:
+		if isinstance(res,Failure):
+			d.errback(res)
+		else:
+			_do_callback(tid,d,res)
+
+class RowStream(object):
+	"""\
+	The result of DoSelect(…, _stream=N): the worker thread fetches N rows
+	at a time and hands each chunk to the reactor.
+
+	get() returns a Deferred for the next chunk (a list of rows); an empty
+	list means that the result is complete. Alternately, each(proc) calls
+	proc(rows) for every chunk; if that returns a Deferred, the next chunk
+	waits for it. `done` fires with the row count.
+
+	Fetching pauses while `backlog` chunks are waiting to be taken, or
+	while the stream is paused (it's an IPushProducer). stopProducing()
+	abandons the rest of the result.
+
+	The connection is busy until the stream is done, so don't wait for
+	other statements on it before you've read (or stopped) the stream.
+	"""
+	implements(IPushProducer)
+
+	def __init__(self, chunk, backlog):
+		self.chunk = chunk
+		self.backlog = backlog
+		self.done = None
+		self._chunks = deque() # delivered, not yet taken
+		self._waiting = deque() # Deferreds from get()
+		self._end = None # row count, or a Failure
+		self._pending = 0 # sent by the worker, not yet taken
+		self._paused = False
+		self._stop = False
+		self._lock = Lock()
+		self._go = Event()
+		self._go.set()
+
+	# worker thread
+
+	def _run(self, db, a, k):
+		k.setdefault('_store',0)
+		it = iter(db.DoSelect(*a,**k))
+		n = 0
+		try:
+			while True:
+				self._go.wait()
+				if self._stop:
+					break
+				rows = list(islice(it,self.chunk))
+				if not rows:
+					break
+				n += len(rows)
+				with self._lock:
+					self._pending += 1
+					if self._pending >= self.backlog:
+						self._go.clear()
+				reactor.callFromThread(self._deliver,rows)
+		except BaseException:
+			reactor.callFromThread(self._finish,Failure())
+			raise
+		finally:
+			close = getattr(it,"close",None)
+			if close is not None:
+				close()
+		reactor.callFromThread(self._finish,n)
+		return n
+
+	# reactor
+
+	def _taken(self):
+		with self._lock:
+			self._pending -= 1
+			if self._pending < self.backlog and not self._paused:
+				self._go.set()
+
+	def _deliver(self, rows):
+		if self._waiting:
+			self._taken()
+			self._waiting.popleft().callback(rows)
+		else:
+			self._chunks.append(rows)
+
+	def _finish(self, res):
+		self._end = res
+		while self._waiting:
+			d = self._waiting.popleft()
+			if isinstance(res,Failure):
+				d.errback(res)
+			else:
+				d.callback([])
+
+	def get(self):
+		if self._chunks:
+			self._taken()
+			return succeed(self._chunks.popleft())
+		if self._end is not None:
+			if isinstance(self._end,Failure):
+				return fail(self._end)
+			return succeed([])
+		d = Deferred()
+		self._waiting.append(d)
+		return d
+
+	@inlineCallbacks
+	def each(self, proc):
+		while True:
+			rows = yield self.get()
+			if not rows:
+				break
+			yield proc(rows)
+		res = yield self.done
+		returnValue( res )
+
+	def pauseProducing(self):
+		with self._lock:
+			self._paused = True
+			self._go.clear()
+
+	def resumeProducing(self):
+		with self._lock:
+			self._paused = False
+			if self._pending < self.backlog:
+				self._go.set()
+
+	def stopProducing(self):
+		self._stop = True
+		self._chunks.clear()
+		self._go.set()
+
 tid = 0
 class _DbThread(object):
 	def __init__(self,parent):
@@ -323,13 +632,17 @@ class _DbThread(object):
 		self.parent = parent
 		self.q = Queue()
 		debug("INIT",self.tid)
-		self.done = threads.deferToThreadPool(reactor, self.parent.threads, self.run,self.q)
+		self.done = None # fires when the worker thread is done
+		self.waiting = None # since when this waits for a connection
+		self.timer = None
 		self.started = False
 		self.count = 0
 
 		self.committed = []
 		self.rolledback = []
 
+	error = None
+
 	def __repr__(self):
 		return "<_DbT.%d>"%(self.tid,)
 
@@ -370,61 +683,132 @@ class _DbThread(object):
 		return d
 
 
-	def run(self,q):
-		try:
-			db = sqlmix.Db(*self.parent.args,**self.parent.kwargs)
-		except BaseException:
-			"""No go. Return that error on every call."""
-			f = Failure()
-			while True:
-				d,proc,a,k = q.get()
-				if not d: break
-				reactor.callFromThread(d.errback,f)
-			return
-		debug("START",self.tid, tname())
-		res = None
-		d = True
-		while d:
-			d = None
-			sent = False
+	def _run_job(self,db,proc,a,k):
+		"""Process one request, in the worker thread"""
+		if self.parent.result_cache is None:
+			# a cache per worker would miss the other workers' writes
+			k.pop('_cache',None)
+		if proc == "COMMIT":
+			db.commit()
+			return k.get('res',None)
+		elif proc == "ROLLBACK":
+			db.rollback()
+			return k.get('res',None)
+		elif proc == "DoSelect":
+			# fetch here, not in the reactor
+			res = db.DoSelect(*a,**k)
+			if not k.get('_callback',None):
+				res = list(res)
+			return res
+		elif proc == "STREAM":
+			return a[0]._run(db,a[1:],k)
+		elif proc == "BATCH":
+			res = []
+			for job in a[0]:
+				args = list(job[1:])
+				kw = dict(args.pop()) if args and isinstance(args[-1],dict) else {}
+				if job[0] in ("STREAM","BATCH"):
+					raise ValueError("Not in a batch",job[0])
+				if job[0] == "DoSelect":
+					kw.setdefault("_store",1)
+				res.append(self._run_job(db,job[0],args,kw))
+			return res
+		r = getattr(db,proc)
+		debug("CALL",self.tid,r)
+		res = r(*a,**k)
+		debug("CALLED",self.tid,res)
+		return res
+
+	def run(self,q,db=None):
+		"""\
+		The worker: process requests until the handle is released
+		(return the connection) or closed (close it, return None).
+		"""
+		if db is None:
 			try:
-				d,proc,a,k = q.get()
-				res = None
-				debug("DO",self.tid,d,proc,a,k)
-				if proc == "COMMIT":
-					db.commit()
-					res = k.get('res',None)
-				elif proc == "ROLLBACK":
-					db.rollback()
-					res = k.get('res',None)
-				else:
-					r = getattr(db,proc)
-					debug("CALL",self.tid,r)
-					res = r(*a,**k)
-					debug("CALLED",self.tid,res)
-			except BaseException as e:
-				res = Failure()
+				db = sqlmix.Db(*self.parent.args,**self.parent.kwargs)
+			except BaseException:
+				"""No go. Return that error on every call."""
+				f = Failure()
+				while True:
+					d,proc,a,k = q.get()
+					if not d: break
+					reactor.callFromThread(d.errback,f)
+				return None
+		debug("START",self.tid, tname())
+		stop = False
+		park = False
+		err = None
+		while not stop:
+			# run everything that's queued, then report back once
+			jobs = [q.get()]
+			while True:
+				try:
+					jobs.append(q.get_nowait())
+				except Empty:
+					break
+			results = []
+			for d,proc,a,k in jobs:
+				if proc == "PARK":
+					# released: keep the connection, free the thread
+					stop = park = True
+					continue
+				if proc == "STREAM" and results:
+					# the stream may wait for its consumer
+					reactor.callFromThread(_do_callbacks,self.tid,results)
+					results = []
+				try:
+					debug("DO",self.tid,d,proc,a,k)
+					res = self._run_job(db,proc,a,k)
+				except BaseException:
+					res = Failure()
+					debug("EB" if d else "ERR",self.tid,d,res)
 				if d:
-					debug("EB",self.tid,d,res)
-					reactor.callFromThread(d.errback,res)
-					sent = True
+					results.append((d,res))
 				else:
-					debug("ERR",self.tid,res)
-					raise
-			finally:
-				if d and not sent:
-					debug("CB",self.tid,d,res)
-					reactor.callFromThread(_do_callback,self.tid,d,res)
+					# no Deferred: stop
+					stop = True
+					if isinstance(res,Failure):
+						err = res
 				debug("DID",self.tid,proc)
+			if results:
+				reactor.callFromThread(_do_callbacks,self.tid,results)
+		if err is not None:
+			err.raiseException()
+		if park:
+			debug("PARK",self.tid)
+			return db
 		db.close()
 		debug("STOP",self.tid)
-		return
+		return None
+
+	def _abort(self,exc):
+		"""Fail the requests of a handle which didn't get a connection"""
+		f = Failure(exc)
+		q,self.q = self.q,None
+		self.waiting = None
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		self.error = f
+		while q is not None and not q.empty():
+			d,proc,a,k = q.get_nowait()
+			if d:
+				d.errback(f)
 
 	def close(self,reason="???"):
 		if self.q is None:
 			if reason != "__del__":
 				debug("DEAD_CALLED_TWICE",self.tid,reason)
 			return
+		if self.waiting is not None:
+			# no connection yet
+			try:
+				self.parent._waiters.remove(self)
+			except ValueError:
+				pass
+			self._abort(RuntimeError("Closed",reason))
+			return
 		self.q.put((None,"ROLLBACK",[],{}))
 		debug("DEAD",self.tid,reason)
 		self.q = None
@@ -433,6 +817,8 @@ class _DbThread(object):
 		self.close("__del__")
 
 	def commit(self,res=None):
+		if self.q is None:
+			return fail(self.error or RuntimeError("Closed DB handle"))
 		d = Deferred()
 		if self.count:
 			debug("CALL COMMIT",self.tid,d,res)
@@ -471,6 +857,8 @@ class _DbThread(object):
 
 	def _do(self,job,*a,**k):
 		"""Wrapper for calling the background thread."""
+		if self.q is None:
+			return fail(self.error or RuntimeError("Closed DB handle"))
 		self.count += 1
 		debug = k.get("_debug",_DEBUG)
 		d = Deferred()
@@ -486,10 +874,52 @@ class _DbThread(object):
 		return self._do("Do",*a,**k)
 	def DoFn(self,*a,**k):
 		return self._do("DoFn",*a,**k)
+	def DoMany(self,*a,**k):
+		return self._do("DoMany",*a,**k)
+	def DoColumns(self,*a,**k):
+		return self._do("DoColumns",*a,**k)
+	def CopyIn(self,*a,**k):
+		return self._do("CopyIn",*a,**k)
+	def CopyOut(self,*a,**k):
+		return self._do("CopyOut",*a,**k)
+	def DoBatch(self,jobs,**k):
+		"""\
+		Run several statements in one trip to the worker thread.
+
+		>>>	a,b = yield db.DoBatch([
+		...		("Do", "insert into foo(x) values(${x})", dict(x=1)),
+		...		("DoFn", "select count(*) from foo"),
+		...	])
+
+		Each job is a method name and its arguments; a trailing dict
+		holds its keywords. The Deferred fires with the list of
+		results, or fails with the first error.
+
+		Statements which you queue without waiting for the previous
+		one's result are also run together, so this is mostly useful
+		when you want all-or-nothing results.
+		"""
+		return self._do("BATCH",list(jobs),**k)
+
 	def DoSelect(self,*a,**k):
-		k["_store"] = 1
-		return self._do("DoSelect",*a,**k)
+		"""\
+		The Deferred fires with a list of rows, which the worker thread
+		has fetched. With _stream=N it fires right away, with a RowStream
+		that delivers N rows at a time; _backlog (default 4) is the
+		number of chunks it may fetch ahead.
+		"""
+		n = k.pop("_stream",None)
+		if not n:
+			k["_store"] = 1
+			return self._do("DoSelect",*a,**k)
+		stream = RowStream(int(n), int(k.pop("_backlog",4)))
+		stream.done = self._do("STREAM",stream,*a,**k)
+		return succeed(stream)
 	Do.__doc__ = sqlmix.Db.Do.__doc__ + "\nReturns a Deferred.\n"
 	DoFn.__doc__ = sqlmix.Db.DoFn.__doc__ + "\nReturns a Deferred.\n"
-	DoSelect.__doc__ = sqlmix.Db.DoSelect.__doc__ + "\nReturns a Deferred.\n"
+	DoMany.__doc__ = sqlmix.Db.DoMany.__doc__ + "\nReturns a Deferred.\n"
+	DoColumns.__doc__ = sqlmix.Db.DoColumns.__doc__ + "\nReturns a Deferred.\n"
+	CopyIn.__doc__ = sqlmix.Db.CopyIn.__doc__ + "\nReturns a Deferred.\n"
+	CopyOut.__doc__ = sqlmix.Db.CopyOut.__doc__ + "\nReturns a Deferred.\n"
+	DoSelect.__doc__ = sqlmix.Db.DoSelect.__doc__ + DoSelect.__doc__
 
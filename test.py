@@ -8,7 +8,12 @@ Simple test script
 """
 
 import os
-from sqlmix import Db,ManyData,NoData
+import io
+import json
+import copy
+import pickle
+import sqlite3
+from sqlmix import Db,ManyData,NoData,Retry,prep_cache,error_kind
 from warnings import filterwarnings
 
 filterwarnings("ignore",category=RuntimeWarning,lineno=15)
@@ -46,6 +51,25 @@ def run_test(x,ai,*a):
 		assert i==j
 		j += 1
 	assert n == 3
+	assert len(list(db.DoSelect("select id from test1", _batch=2))) == 3
+	assert next(db.DoSelect("select id,a from test1", _head=1)) == ["id","a"]
+	for kind in ("namedtuple","slots"):
+		r = list(db.DoSelect("select id,a from test1 order by id", _record=kind))
+		assert [(x.id,x.a) for x in r] == [(A,"one"),(B,"two"),(C,"")], r
+	r = list(db.DoSelect("select id,a from test1 order by id", _dict=True))
+	assert r[2] == dict(id=C,a=""), r
+	r = db.DoFn("select count(*) from test1", _record="slots")
+	assert tuple(r) == (3,), r
+	r = list(db.DoSelect("select id,a from test1 order by id", _row=True))
+	assert r[0].a == r[0]["a"] == r[0][1] == "one", r
+	assert r[1] == (B,"two"), r
+	assert copy.copy(r[0]) == r[0] and pickle.loads(pickle.dumps(r[0])).a == "one"
+	r = db.DoFn("select 1 as id, 2 as x, 3 as id", _row=True)
+	assert r.id == 1 and r._2 == 3 and r.keys() == ["id","x","_2"], r
+	assert dict(r._asdict()) == dict(id=1,x=2,_2=3) and repr(r) == "Row(id=1, x=2, _2=3)", r
+	cols = db.DoColumns("select id,a from test1 order by id", _batch=2, _numpy=False)
+	assert list(cols["id"]) == [A,B,C], cols
+	assert cols["a"] == ["one","two",""], cols
 	try:
 		db.DoFn("select id from test1")
 	except ManyData:
@@ -63,11 +87,101 @@ def run_test(x,ai,*a):
 
 	for i, in db.DoSelect("select id from test1 where id < 0", _empty=True):
 		assert False,"Returned nonsense"
+
+	n = db.DoMany("insert into test1(a,b) values (${a},${b})", [dict(a="four",b="x"),("five",None),("six","y")], _chunk=2)
+	assert n == 3, n
+	n, = db.DoFn("select count(*) from test1")
+	assert n == 6, n
+	n = db.DoMany("insert into test1(a,b) values (${a},${b})", [("seven",None),("eight","z")], _values=False)
+	assert n == 2, n
+	db.rollback()
+
+	n = db.CopyIn("test1", ("a","b"), (("copy%d" % i, None if i%2 else "x\ty") for i in range(5)))
+	assert n == 5, n
+	f = io.StringIO()
+	n = db.CopyOut("select a,b from test1 where a like ${a} order by id", f, a="copy%")
+	assert n == 5, n
+	assert f.getvalue().startswith("copy0\tx\\ty\ncopy1\t\\N\n"), f.getvalue()
+	db.rollback()
+	print("Success.")
+
+def run_pool_test(x):
+	db = Db("db"+str(x),config="test.ini", pool_size=1, pool_timeout=1, instrument=True,
+		slow_query_ms=0, slow_query_log="test-slow.log", slow_query_explain=True)
+	with db:
+		n, = db.DoFn("select count(*) from test1")
+		assert n == 3, n
+	st = db.instrument.report()
+	assert st[0]["sql"] == "select count(*) from test1" and st[0]["rows"] == 1, st
+	with open("test-slow.log") as f:
+		e = json.loads(f.readline())
+	assert e["sql"] == "select count(*) from test1" and "plan" in e, e
+	assert db.pool.stats()["idle"] == 1
+	with db:
+		n, = db.DoFn("select count(*) from test1")
+	assert db.pool.stats()["size"] == 1
+	with db:
+		try:
+			db.DoMany("insert into test1(a,b) values (${a},${b})", [("short",)])
+		except ValueError: pass
+		else: assert False
+	assert [s["errors"] for s in db.instrument.report() if s["sql"].startswith("insert")] == [1]
+
+	policy = Retry(attempts=3, base=0.001)
+	tries = []
+	def job(db):
+		tries.append(db.DoFn("select count(*) from test1"))
+		if len(tries) < 3:
+			raise sqlite3.OperationalError("database is locked")
+		return len(tries)
+	assert db(job, policy) == 3
+	assert policy.stats()["retries"] == {"lock_timeout":2}, policy.stats()
+	assert error_kind(RuntimeError(1213,"not a driver error")) is None
+	try:
+		db(lambda db: 1/0, policy)
+	except ZeroDivisionError: pass
+	else: assert False
+	assert policy.stats()["errors"] == 1
+	assert db.pool.stats()["idle"] == 1
+
+	# the same file serves as a "replica"
+	db = Db("db"+str(x),config="test.ini", replicas=[dict(database="test.db")])
+	n, = db.DoFn("select count(*) from test1")
+	assert db.replica_stats()[0]["reads"] == 1
+	db.Do("update test1 set b=b", _empty=1)
+	n, = db.DoFn("select count(*) from test1")
+	assert db.replica_stats()[0]["reads"] == 1
+	db.rollback()
+	n, = db.DoFn("select count(*) from test1")
+	assert db.replica_stats()[0]["reads"] == 2
+	db.rollback()
+	def lost(_cmd, **kv): # the replica's connection breaks while reading
+		raise ConnectionError("server closed the connection")
+		yield
+	db.replicas.dbs[0].DoSelect = lost
+	assert len(list(db.DoSelect("select id from test1"))) == n
+	assert db.replica_stats()[0]["busy"] == 0
+	db.rollback()
+
+	db = Db("db"+str(x),config="test.ini", result_cache=True)
+	prep_cache.clear()
+	n, = db.DoFn("select count(*) from test1", _cache=60)
+	assert db.DoFn("select count(*) from test1", _cache=60) == (n,)
+	assert db.result_cache.stats()["hits"] == 1
+	e = db.result_cache.store(None, (), (), [("x",)], [([1],)], 60)
+	e.row(e.rows[0])[0].append(2)
+	assert e.rows[0] == ([1],), e.rows # mutable values are copied
+	assert prep_cache.stats()["size"] == 1, prep_cache.stats() # only the template
+	db.Do("update test1 set b=b", _empty=1)
+	db.commit()
+	assert db.result_cache.stats()["size"] == 0
 	print("Success.")
 
-try: os.unlink("test.db")
-except EnvironmentError: pass
+for f in ("test.db","test-slow.log"):
+	try: os.unlink(f)
+	except EnvironmentError: pass
 run_test(1,"")
+run_pool_test(1)
 run_test(2,"auto_increment","create database if not exists test_sqlmix","drop table if exists test1")
 run_test(3,"auto_increment","drop table if exists test1")
 
@@ -68,9 +68,23 @@ async def run_test(x,ai):
 
     async for i, in db.DoSelect("select id from test1 where id < 0", _empty=True):
         assert False,"Returned nonsense"
+
+    n = await db.DoMany("insert into test1(a,b) values (${a},${b})", [dict(a="four",b="x"),("five",None)], _chunk=1)
+    assert n == 2, n
+    await db.rollback()
   print("Success.")
 
+def test_isolation():
+    try:
+        dbp = Db(dbtype="postgres", database="test_sqlmix", isolation="serializable")
+    except ImportError:
+        return
+    assert dbp.DB.isolation == "serializable"
+    assert "isolation" not in dbp.DB.kwargs, dbp.DB.kwargs
+
 async def run_tests():
+    test_isolation()
+    await run_test(1,"")
     await run_test(2,"auto_increment")
 #run_test(3,"auto_increment","drop table if exists test1")
 